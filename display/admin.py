@@ -1,6 +1,7 @@
 from django.contrib import admin
 
-from display.models import ImageSlide, DisplayConfiguration, DisplayConfigurationItem
+from display.models import ImageSlide, DisplayConfiguration, DisplayConfigurationItem, RoomAlias, \
+    AvailabilityRule, AvailabilityException
 
 
 @admin.register(ImageSlide)
@@ -16,3 +17,20 @@ class DisplayConfigurationItemInline(admin.StackedInline):
 class DisplayConfigurationAdmin(admin.ModelAdmin):
     list_display = ['name', 'title']
     inlines = [DisplayConfigurationItemInline]
+
+
+@admin.register(RoomAlias)
+class RoomAliasAdmin(admin.ModelAdmin):
+    list_display = ["name", "alias"]
+
+
+@admin.register(AvailabilityRule)
+class AvailabilityRuleAdmin(admin.ModelAdmin):
+    list_display = ["weekday", "start", "end", "display"]
+    list_filter = ["display"]
+
+
+@admin.register(AvailabilityException)
+class AvailabilityExceptionAdmin(admin.ModelAdmin):
+    list_display = ["date", "reason", "display"]
+    list_filter = ["display"]
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class DisplayConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "display"
+
+    def ready(self):
+        from display import signals  # noqa: F401
@@ -0,0 +1,117 @@
+"""
+The always-on times of the displays: AvailabilityRules minus AvailabilityExceptions.
+
+Both tables are compiled into one sorted list of local time ranges per weekday and
+display, and only recompiled when one of them changes. Local times are turned into
+aware datetimes per date, so the switch to and from daylight saving time moves
+nothing.
+"""
+import collections
+import uuid
+from datetime import datetime, timedelta
+
+from django.core.cache import cache
+from django.utils import timezone
+
+from display.models import AvailabilityException, AvailabilityRule
+
+AVAILABILITY_VERSION_KEY = "availability:version"
+
+_compiled = (None, None)  # version, Availability
+
+
+def merge(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+
+    return merged
+
+
+class Availability:
+    """
+    rules: (display_id or None, weekday, start, end), exceptions: (display_id or None, date).
+    None stands for all displays.
+    """
+
+    def __init__(self, rules, exceptions):
+        ranges = collections.defaultdict(list)
+        for display_id, weekday, start, end in rules:
+            ranges[display_id, weekday].append((start, end))
+
+        self.ranges = {key: merge(value) for key, value in ranges.items()}
+        self.exceptions = set(exceptions)
+
+    def ranges_on(self, display_id, date):
+        """
+        the local (start, end) times display_id is always on at date.
+        """
+        if (None, date) in self.exceptions or (display_id, date) in self.exceptions:
+            return []
+
+        weekday = date.isoweekday()
+        if display_id is None:
+            return self.ranges.get((None, weekday), [])
+
+        return merge(self.ranges.get((None, weekday), []) + self.ranges.get((display_id, weekday), []))
+
+    def intervals(self, display_id, begin, end):
+        """
+        the always-on intervals of display_id overlapping [begin, end), as aware datetimes.
+        """
+        tz = timezone.get_current_timezone()
+        date = timezone.localtime(begin, tz).date()
+        last = timezone.localtime(end, tz).date()
+
+        intervals = []
+        while date <= last:
+            for start, stop in self.ranges_on(display_id, date):
+                start = timezone.make_aware(datetime.combine(date, start), tz)
+                stop = timezone.make_aware(datetime.combine(date, stop), tz)
+                if start < end and stop > begin:
+                    intervals.append((start, stop))
+
+            date += timedelta(days=1)
+
+        return intervals
+
+
+def availability():
+    """
+    the Availability for the current tables. only recompiled after they changed.
+    """
+    global _compiled
+
+    version = cache.get(AVAILABILITY_VERSION_KEY)
+    built_for, compiled = _compiled
+    if compiled is None or built_for != version:
+        compiled = Availability(
+            AvailabilityRule.objects.values_list("display_id", "weekday", "start", "end"),
+            AvailabilityException.objects.values_list("display_id", "date"),
+        )
+        _compiled = (version, compiled)
+
+    return compiled
+
+
+def availability_version():
+    return cache.get(AVAILABILITY_VERSION_KEY)
+
+
+def forget_availability():
+    """
+    the rules changed, every process has to recompile them
+    """
+    global _compiled
+    cache.set(AVAILABILITY_VERSION_KEY, uuid.uuid4().hex, None)
+    _compiled = (None, None)
+
+
+def always_on_intervals(display_id, day):
+    """
+    when display_id is always on during the (utc) day starting at midnight day.
+    """
+    return availability().intervals(display_id, day, day + timedelta(days=1))
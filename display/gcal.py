@@ -0,0 +1,211 @@
+"""
+Google Calendar API plumbing shared by the models, views and management commands.
+
+get_credentials() keeps the access tokens in memory until shortly before they expire.
+Refreshing is single-flight: per process through a lock, across the uwsgi workers
+through a lock entry in the cache. Whoever does not get the lock waits for the new
+token to show up in the database.
+
+build("calendar", "v3") reads and parses the discovery document and sets up a new
+http transport every time. Here the parsed document is kept per process and the
+http connections per thread (httplib2 is not thread safe), so the TLS connection
+to google stays open between two fetches. Timeouts and circuit breakers come from
+display.http.
+"""
+import collections
+import json
+import logging
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from allauth.socialaccount.models import SocialToken
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+
+from display.http import Http, session
+
+_documents = {}
+_documents_lock = threading.Lock()
+
+_local = threading.local()
+
+_credentials = {}
+_credentials_lock = threading.Lock()
+_refresh_locks = collections.defaultdict(threading.Lock)
+
+# refresh tokens this long before they expire
+EXPIRY_MARGIN = timedelta(minutes=5)
+# how long a refresh may take before others stop waiting for it
+REFRESH_LOCK_TIMEOUT = 30
+
+logger = logging.getLogger(__name__)
+
+
+class NoCredentials(Exception):
+    """
+    the owner of a calendar has no google token (anymore), somebody has to log in with google again
+    """
+
+
+def discovery_document(name="calendar", version="v3"):
+    """
+    the parsed discovery document, from the copy that ships with googleapiclient.
+    works offline and is only read once per process.
+    """
+    key = (name, version)
+    document = _documents.get(key)
+    if document is None:
+        with _documents_lock:
+            document = _documents.get(key)
+            if document is None:
+                content = get_static_doc(name, version)
+                if content is None:
+                    raise LookupError(f"no discovery document for {name} {version}")
+
+                document = _documents[key] = json.loads(content)
+
+    return document
+
+
+def pooled_http(key):
+    """
+    one httplib2.Http per thread and credential. it keeps its connections open, so
+    following requests skip the TCP and TLS handshake.
+    """
+    pool = getattr(_local, "http", None)
+    if pool is None:
+        pool = _local.http = {}
+
+    http = pool.get(key)
+    if http is None:
+        http = pool[key] = Http()
+
+    return http
+
+
+def calendar_service(credentials):
+    """
+    drop-in replacement for build("calendar", "v3", credentials=credentials)
+    """
+    http = AuthorizedHttp(credentials, http=pooled_http(credentials.refresh_token or credentials.token))
+    return build_from_document(discovery_document(), http=http)
+
+
+def is_fresh(credentials):
+    if not credentials.token or credentials.expiry is None:
+        return False
+
+    return credentials.expiry - EXPIRY_MARGIN > datetime.utcnow()
+
+
+def load_credentials(user_id):
+    token = SocialToken.objects.filter(
+        account__user_id=user_id, account__provider="google"
+    ).first()
+    if token is None:
+        return None
+
+    expiry = None
+    if token.expires_at:
+        # google.auth wants naive utc
+        expiry = timezone.make_naive(token.expires_at, timezone.utc)
+
+    return Credentials(
+        token=token.token,
+        refresh_token=token.token_secret,
+        token_uri="https://oauth2.googleapis.com/token",
+        client_id=settings.SOCIALACCOUNT_PROVIDERS["google"]["APP"]["client_id"],
+        client_secret=settings.SOCIALACCOUNT_PROVIDERS["google"]["APP"]["secret"],
+        expiry=expiry,
+    )
+
+
+def refresh_credentials(user_id, credentials):
+    credentials.refresh(Request(session=session()))
+
+    changes = dict(token=credentials.token)
+    if credentials.expiry:
+        changes["expires_at"] = timezone.make_aware(credentials.expiry, timezone.utc)
+    if credentials.refresh_token:
+        changes["token_secret"] = credentials.refresh_token
+
+    SocialToken.objects.filter(
+        account__user_id=user_id, account__provider="google"
+    ).update(**changes)
+
+    return credentials
+
+
+def refresh_single_flight(user_id, credentials):
+    lock_key = f"gcal:refresh:{user_id}"
+    token = uuid.uuid4().hex
+
+    if cache.add(lock_key, token, timeout=REFRESH_LOCK_TIMEOUT):
+        try:
+            # somebody might have finished just before we got the lock
+            loaded = load_credentials(user_id)
+            if loaded is not None and is_fresh(loaded):
+                return loaded
+
+            return refresh_credentials(user_id, credentials)
+        finally:
+            # after REFRESH_LOCK_TIMEOUT, the lock may belong to somebody else
+            if cache.get(lock_key) == token:
+                cache.delete(lock_key)
+
+    # every look at the lock is a query with the database cache, so not too often
+    delay = 0.1
+    deadline = time.monotonic() + REFRESH_LOCK_TIMEOUT
+    while time.monotonic() < deadline and cache.get(lock_key):
+        time.sleep(delay)
+        delay = min(delay * 2, 1)
+
+    loaded = load_credentials(user_id)
+    if loaded is not None and is_fresh(loaded):
+        return loaded
+
+    logger.warning("waited for somebody else to refresh the token of user %s, in vain", user_id)
+    return refresh_credentials(user_id, credentials)
+
+
+def get_credentials(user):
+    """
+    valid google credentials for user (or a user id), None if there is no google token.
+    raises RefreshError if the token can't be refreshed.
+    """
+    user_id = getattr(user, "pk", user)
+
+    credentials = _credentials.get(user_id)
+    if credentials is not None and is_fresh(credentials):
+        return credentials
+
+    with _credentials_lock:
+        refresh_lock = _refresh_locks[user_id]
+
+    with refresh_lock:
+        credentials = _credentials.get(user_id)
+        if credentials is not None and is_fresh(credentials):
+            return credentials
+
+        credentials = load_credentials(user_id)
+        if credentials is None:
+            _credentials.pop(user_id, None)
+            return None
+
+        if not is_fresh(credentials):
+            try:
+                credentials = refresh_single_flight(user_id, credentials)
+            except Exception:
+                _credentials.pop(user_id, None)
+                raise
+
+        _credentials[user_id] = credentials
+        return credentials
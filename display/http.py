@@ -0,0 +1,172 @@
+"""
+Outbound HTTP: the scraper through requests, google through httplib2.
+
+Both get connect and read timeouts and share one circuit breaker per host. After
+HTTP_BREAKER_FAILURES failures in a row a host is left alone for
+HTTP_BREAKER_RESET seconds, requests to it fail right away with CircuitOpen and the
+callers serve what they have in the cache. After that one request may try again.
+
+requests sessions are kept per thread and keep their connections open. GETs are
+retried a few times on connection errors and 502/503/504.
+"""
+import logging
+import threading
+import time
+from urllib.parse import urlsplit
+
+import httplib2
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+class CircuitOpen(requests.exceptions.ConnectionError):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, host):
+        self.host = host
+        self.failures = 0
+        self.opened_at = None
+        self.trying = False
+        self.lock = threading.Lock()
+
+    def check(self):
+        """
+        raises CircuitOpen if nobody should talk to the host right now
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return
+
+            if self.trying or time.monotonic() - self.opened_at < settings.HTTP_BREAKER_RESET:
+                raise CircuitOpen(f"{self.host} failed {self.failures} times in a row, not trying for now")
+
+            # half open: this one may try
+            self.trying = True
+
+    def success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                logger.info("%s is back", self.host)
+            self.failures = 0
+            self.opened_at = None
+            self.trying = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trying = False
+            if self.failures >= settings.HTTP_BREAKER_FAILURES:
+                if self.opened_at is None:
+                    logger.warning("%s failed %d times in a row, leaving it alone for %s seconds",
+                                   self.host, self.failures, settings.HTTP_BREAKER_RESET)
+                self.opened_at = time.monotonic()
+
+
+def breaker(url):
+    host = urlsplit(url).hostname or ""
+    with _breakers_lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker(host)
+        return _breakers[host]
+
+
+def breakers():
+    """
+    the hosts with failures, for the wartungsklappe
+    """
+    with _breakers_lock:
+        return [b for b in _breakers.values() if b.failures]
+
+
+def timeout():
+    return settings.HTTP_CONNECT_TIMEOUT, settings.HTTP_READ_TIMEOUT
+
+
+class Session(requests.Session):
+    """
+    requests.Session with timeouts, retries and the circuit breakers
+    """
+
+    def __init__(self):
+        super().__init__()
+        retry = Retry(
+            total=settings.HTTP_RETRIES,
+            backoff_factor=0.5,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(["GET", "HEAD"]),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(max_retries=retry)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, method, url, *args, **kwargs):
+        # google.auth passes its own timeout of two minutes, that's too long for us
+        if not isinstance(kwargs.get("timeout"), tuple):
+            limit = kwargs.get("timeout") or settings.HTTP_READ_TIMEOUT
+            kwargs["timeout"] = (settings.HTTP_CONNECT_TIMEOUT, min(limit, settings.HTTP_READ_TIMEOUT))
+
+        b = breaker(url)
+        b.check()
+        try:
+            response = super().request(method, url, *args, **kwargs)
+        except requests.exceptions.RequestException:
+            b.failure()
+            raise
+
+        if response.status_code >= 500:
+            b.failure()
+        else:
+            b.success()
+        return response
+
+
+def session():
+    """
+    the Session of this thread
+    """
+    s = getattr(_local, "session", None)
+    if s is None:
+        s = _local.session = Session()
+    return s
+
+
+def get(url, **kwargs):
+    return session().get(url, **kwargs)
+
+
+class Http(httplib2.Http):
+    """
+    httplib2.Http with the read timeout and the circuit breakers, for googleapiclient
+    """
+
+    def __init__(self):
+        super().__init__(timeout=settings.HTTP_READ_TIMEOUT)
+        # like googleapiclient.http.build_http(): 308 is no redirect for google
+        self.redirect_codes = self.redirect_codes - {308}
+
+    def request(self, uri, *args, **kwargs):
+        b = breaker(uri)
+        b.check()
+        try:
+            response, content = super().request(uri, *args, **kwargs)
+        except Exception:
+            b.failure()
+            raise
+
+        if response.status >= 500:
+            b.failure()
+        else:
+            b.success()
+        return response, content
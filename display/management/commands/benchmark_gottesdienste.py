@@ -0,0 +1,42 @@
+import timeit
+from pathlib import Path
+
+from bs4 import BeautifulSoup, SoupStrainer
+from django.core.management.base import BaseCommand
+
+from display.sources import HTML_PARSER, parse_gottesdienste
+
+TESTDATA = Path(__file__).resolve().parents[2] / "testdata"
+
+# what the scraper used before, the others are compared to it
+BASELINE = "html.parser"
+
+
+class Command(BaseCommand):
+    help = "How long parsing the saved Gottesdienst pages takes, per parser: whole page, just the tables, all of parse_gottesdienste()"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--number", type=int, default=20, help="parses per measurement")
+
+    def handle(self, *args, **options):
+        number = options["number"]
+        parsers = [BASELINE] + ([HTML_PARSER] if HTML_PARSER != BASELINE else [])
+
+        for page in sorted(TESTDATA.glob("gottesdienste_*.html")):
+            html = page.read_text()
+            baseline = None
+            for parser in parsers:
+                whole = timeit.timeit(lambda: BeautifulSoup(html, parser), number=number) / number
+                tables = timeit.timeit(
+                    lambda: BeautifulSoup(html, parser, parse_only=SoupStrainer("table", class_="contenttable")),
+                    number=number) / number
+                scrape = timeit.timeit(lambda: parse_gottesdienste(html, parser), number=number) / number
+
+                if baseline is None:
+                    baseline = whole
+
+                self.stdout.write(
+                    f"{page.name} {parser}: whole page {whole * 1000:.1f} ms, "
+                    f"tables only {tables * 1000:.1f} ms, parse_gottesdienste() {scrape * 1000:.1f} ms "
+                    f"({baseline / scrape:.1f}x faster than the whole page with {BASELINE})"
+                )
@@ -1,47 +1,93 @@
+import json
 import sys
+import time
 from datetime import timedelta
 
 from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
 from django.utils.timezone import now
 
 from display.models import DisplayConfiguration
-from display.views import load_events, iter_items
+from display.sources import NO_EVENTS, calendar_key, fetch_all
+from display.views import iter_items
+
+
+def is_active(items, fetched, n):
+    for item in items:
+        if item.calendar:
+            today = fetched.get(calendar_key(item.calendar), NO_EVENTS).today_index
+            if not today:
+                continue
+
+            # from an hour before an event starts until it ends, at least for an hour after the start
+            if today.active_at(n, lead=timedelta(hours=1)) or today.starting_between(n - timedelta(hours=1), n + timedelta(hours=1)):
+                return True
+
+    return False
 
 
 class Command(BaseCommand):
     help = "Check, wether the displat should be active (TV on)"
 
     def add_arguments(self, parser):
-        parser.add_argument("display_name", type=str)
+        parser.add_argument("display_name", type=str, nargs="?")
+        parser.add_argument("--all", action="store_true", help="check every display")
+        parser.add_argument("--json", action="store_true", help="one json object per display and line")
+        parser.add_argument("--follow", action="store_true",
+                            help="keep running, print a line whenever a display changes its state")
+        parser.add_argument("--interval", type=int, default=60, help="seconds between two checks with --follow")
 
     def handle(self, *args, **options):
+        if options["all"] == bool(options["display_name"]):
+            raise CommandError("either a display name or --all")
+
+        if options["display_name"] and not DisplayConfiguration.objects.filter(name=options["display_name"]).exists():
+            raise CommandError(f"no display {options['display_name']}")
+
+        states = {}
+        while True:
+            started = time.monotonic()
+            close_old_connections()
 
-        cfg = DisplayConfiguration.objects.get(name=options["display_name"])
+            for name, active in self.check(options["display_name"]).items():
+                if states.get(name) != active:
+                    states[name] = active
+                    self.report(name, active, options["json"])
 
-        for item in iter_items(cfg):
-            if item.calendar:
-                today_events = load_events(item.calendar)[0]
-                n = now()
-                active = False
-                for event in today_events:
-                    active |= n - timedelta(hours=1) <= event.start <= n + timedelta(hours=1)
-                    active |= event.start <= n <= event.end
-                    active |= n  <= event.end <= n + timedelta(hours=1)
-                    if active:
-                        break
+            if not options["follow"]:
+                break
 
-                if active:
-                    break
+            time.sleep(max(0.0, options["interval"] - (time.monotonic() - started)))
 
+        if not options["all"] and not any(states.values()):
+            sys.exit(5)
+
+    def check(self, name=None):
+        """
+        {display name: should it be on}, every calendar is only fetched once.
+        """
+        displays = DisplayConfiguration.objects.all()
+        if name:
+            displays = displays.filter(name=name)
+
+        items = {cfg.name: [item for item in iter_items(cfg).select_related("calendar") if item.calendar] for cfg in displays}
+        fetched = fetch_all([item for display_items in items.values() for item in display_items])
 
+        n = now()
+        return {name: is_active(display_items, fetched, n) for name, display_items in items.items()}
 
-        if active:
+    def report(self, name, active, as_json):
+        if as_json:
+            self.stdout.write(json.dumps({"display": name, "active": active, "checked": now().isoformat()}))
+
+        elif active:
             self.stdout.write(
-                self.style.SUCCESS("Display should be ON")
+                self.style.SUCCESS(f"Display {name} should be ON")
             )
 
         else:
             self.stdout.write(
-                self.style.SUCCESS("Display should be OFF")
+                self.style.SUCCESS(f"Display {name} should be OFF")
             )
-            sys.exit(5)
+
+        self.stdout.flush()
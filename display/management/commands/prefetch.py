@@ -0,0 +1,44 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from display.models import CalendarConnection, DisplayConfigurationItem
+from display.sources import refresh_calendars, refresh_gottesdienste
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Keep calendar events and gottesdienste fresh in the cache, so the displays never wait for google"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=int, default=settings.PREFETCH_INTERVAL,
+                            help="seconds between two rounds")
+        parser.add_argument("--once", action="store_true", help="just one round, then exit")
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.monotonic()
+            self.prefetch()
+
+            if options["once"]:
+                break
+
+            time.sleep(max(0.0, options["interval"] - (time.monotonic() - started)))
+
+    def prefetch(self):
+        close_old_connections()
+
+        try:
+            refresh_calendars(CalendarConnection.objects.all())
+        except Exception:
+            logger.exception("prefetch of calendars failed")
+
+        if DisplayConfigurationItem.objects.filter(typ="gottesdienste").exists():
+            try:
+                refresh_gottesdienste()
+            except Exception:
+                logger.exception("prefetch of gottesdienste failed")
@@ -0,0 +1,83 @@
+# Generated by Django 4.2.6 on 2026-10-18 09:44
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("display", "0011_displayconfiguration_effect"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="calendarconnection",
+            name="last_full_sync",
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name="calendarconnection",
+            name="last_sync",
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name="calendarconnection",
+            name="sync_token",
+            field=models.CharField(blank=True, default="", max_length=4096),
+        ),
+        migrations.AlterField(
+            model_name="displayconfiguration",
+            name="effect",
+            field=models.CharField(
+                blank=True,
+                choices=[
+                    ("", "Kein Effekt"),
+                    ("plasma_of_love", "Plasma of Love by Kevin Roast"),
+                    ("emoji_rain", "Emoji-Matrix"),
+                ],
+                default="",
+                max_length=1024,
+            ),
+        ),
+        migrations.CreateModel(
+            name="CalendarEvent",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("event_id", models.CharField(max_length=1024)),
+                ("start", models.DateTimeField()),
+                ("end", models.DateTimeField()),
+                ("data", models.JSONField(default=dict)),
+                (
+                    "calendar",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="events",
+                        to="display.calendarconnection",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["calendar", "start"],
+                        name="display_cal_calenda_902831_idx",
+                    )
+                ],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="calendarevent",
+            constraint=models.UniqueConstraint(
+                fields=("calendar", "event_id"), name="unique_calendar_event"
+            ),
+        ),
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 4.2.6 on 2026-10-18 09:51
+
+from django.db import migrations, models
+
+# the rooms that used to be hard coded in massage_kalendereintrag()
+KNOWN_ROOMS = {
+    "1/3 Saal": "⅓ Saal",
+    "1/3Saal": "⅓ Saal",
+    "2/3 Saal": "⅔ Saal",
+    "3/3 Saal": "Ganzer Saal",
+    "MuKiRaum": "MuKi-Raum",
+    "Sonnengruppenraum": "Sonnengruppenraum",
+    "SonnengrupRraum": "Sonnengruppenraum",
+    "Jugendräume": "Jugendräume",
+    "Saal": "Ganzer Saal",
+    "Gemeindebüro": "Gemeindebüro",
+}
+
+
+def add_known_rooms(apps, schema_editor):
+    RoomAlias = apps.get_model("display", "RoomAlias")
+    RoomAlias.objects.bulk_create(
+        [RoomAlias(name=name, alias=alias) for name, alias in KNOWN_ROOMS.items()]
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("display", "0012_calendarevent_calendarconnection_sync"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RoomAlias",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "name",
+                    models.CharField(
+                        help_text="So steht der Raum in den Kalender-Einträgen, Groß- und Kleinschreibung egal.",
+                        max_length=255,
+                        unique=True,
+                        verbose_name="Name im Kalender",
+                    ),
+                ),
+                (
+                    "alias",
+                    models.CharField(
+                        help_text="So wird der Raum auf dem Display angezeigt.",
+                        max_length=255,
+                        verbose_name="Anzeige",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Raum",
+                "verbose_name_plural": "Räume",
+                "ordering": ["alias", "name"],
+            },
+        ),
+        migrations.RunPython(add_known_rooms, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,125 @@
+# Generated by Django 4.2.6 on 2026-10-18 09:55
+
+import datetime
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# the office hours that used to be hard coded in should_be_always_on():
+# 10-12 CET plus one hour in each direction
+OFFICE_HOURS = [
+    (2, datetime.time(9), datetime.time(14)),
+    (4, datetime.time(9), datetime.time(14)),
+    (3, datetime.time(14), datetime.time(19)),
+]
+
+
+def add_office_hours(apps, schema_editor):
+    AvailabilityRule = apps.get_model("display", "AvailabilityRule")
+    AvailabilityRule.objects.bulk_create(
+        [
+            AvailabilityRule(weekday=weekday, start=start, end=end)
+            for weekday, start, end in OFFICE_HOURS
+        ]
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("display", "0013_roomalias"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AvailabilityRule",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "weekday",
+                    models.IntegerField(
+                        choices=[
+                            (1, "Montag"),
+                            (2, "Dienstag"),
+                            (3, "Mittwoch"),
+                            (4, "Donnerstag"),
+                            (5, "Freitag"),
+                            (6, "Samstag"),
+                            (7, "Sonntag"),
+                        ],
+                        verbose_name="Wochentag",
+                    ),
+                ),
+                (
+                    "start",
+                    models.TimeField(help_text="Ortszeit (hh:mm)", verbose_name="Von"),
+                ),
+                (
+                    "end",
+                    models.TimeField(help_text="Ortszeit (hh:mm)", verbose_name="Bis"),
+                ),
+                (
+                    "display",
+                    models.ForeignKey(
+                        blank=True,
+                        help_text="Leer lassen, wenn die Zeit für alle Displays gilt.",
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="availability_rules",
+                        to="display.displayconfiguration",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Immer-an-Zeit",
+                "verbose_name_plural": "Immer-an-Zeiten",
+                "ordering": ["weekday", "start"],
+            },
+        ),
+        migrations.CreateModel(
+            name="AvailabilityException",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("date", models.DateField(verbose_name="Datum")),
+                (
+                    "reason",
+                    models.CharField(
+                        blank=True, default="", max_length=255, verbose_name="Grund"
+                    ),
+                ),
+                (
+                    "display",
+                    models.ForeignKey(
+                        blank=True,
+                        help_text="Leer lassen, wenn der Tag für alle Displays gilt.",
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="availability_exceptions",
+                        to="display.displayconfiguration",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Ausnahme von den Immer-an-Zeiten",
+                "verbose_name_plural": "Ausnahmen von den Immer-an-Zeiten",
+                "ordering": ["date"],
+            },
+        ),
+        migrations.RunPython(add_office_hours, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.6 on 2026-10-18 10:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("display", "0014_availability"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="displayconfiguration",
+            name="modified",
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name="displayconfigurationitem",
+            name="modified",
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
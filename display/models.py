@@ -1,18 +1,24 @@
+import collections
 import logging
 from datetime import datetime, timedelta
 
-from allauth.socialaccount.models import SocialToken
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
 from django.conf import settings
 from django.utils import timezone
-from google.auth.exceptions import RefreshError
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+
+from display.gcal import NoCredentials, calendar_service, get_credentials
 
 
 # Create your models here.
 logger = logging.getLogger(__name__)
 
+
+def start_of_day():
+    return timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+
+
 class ImageSlide(models.Model):
     title = models.CharField("Titel", max_length=1024)
     image = models.ImageField("Bild", upload_to="images/%Y/%m/%d/", blank=False)
@@ -35,61 +41,242 @@ class CalendarConnection(models.Model):
     calendar_id = models.CharField(max_length=4096)
     summary = models.CharField(max_length=4096, blank=True, default="")
 
+    sync_token = models.CharField(max_length=4096, blank=True, default="")
+    last_sync = models.DateTimeField(null=True, blank=True, default=None)
+    last_full_sync = models.DateTimeField(null=True, blank=True, default=None)
+
     def __str__(self):
         return f"Calendar {self.summary}"
 
-    def load_events(self, howmany=30):
+    def sync_due(self):
+        if not self.last_sync:
+            return True
 
-        try:
-            token = SocialToken.objects.get(
-                account__user=self.user, account__provider="google"
-            )
-        except SocialToken.DoesNotExist:
-            return []
+        return self.last_sync + timedelta(seconds=settings.CALENDAR_SYNC_INTERVAL) < timezone.now()
 
+    def full_sync_due(self):
+        """
+        the full sync window starts at the beginning of the day, so roll it over once a day.
+        also needed for recurring events entering the window, these do not show up as changes.
+        """
+        if not self.sync_token or not self.last_full_sync:
+            return True
+
+        return self.last_full_sync < start_of_day()
+
+    def sync_events(self):
+        """
+        bring the local event store up to date.
+
+        uses the syncToken of the last run, so google only sends what changed since then.
+        does a full sync if there is no token yet, it is too old or google says it's gone (410).
+        raises NoCredentials if the owner has no google token.
+        """
+        credentials = get_credentials(self.user_id)
+        if credentials is None:
+            raise NoCredentials(f"user {self.user_id} has no google token")
+
+        service = calendar_service(credentials)
+
+        full = self.full_sync_due()
         try:
-            credentials = Credentials(
-                token=token.token,
-                refresh_token=token.token_secret,
-                token_uri="https://oauth2.googleapis.com/token",
-                client_id=settings.SOCIALACCOUNT_PROVIDERS["google"]["APP"][
-                    "client_id"
-                ],  # replace with yours
-                client_secret=settings.SOCIALACCOUNT_PROVIDERS["google"]["APP"][
-                    "secret"
-                ],
-            )
+            items, sync_token = self.fetch_changes(service, full)
+        except HttpError as e:
+            if full or e.resp.status != 410:
+                raise
+
+            logger.info("sync token for %s expired, doing a full sync", self)
+            full = True
+            items, sync_token = self.fetch_changes(service, full)
 
-            if not credentials or not credentials.valid or credentials.expired and token.token_secret:
-                credentials.refresh()
-                token.token = credentials.token
-                if credentials.refresh_token and credentials.refresh_token != token.token_secret:
-                    token.token_secret = credentials.refresh_token
-
-                token.save()
-
-            utcnow = datetime.utcnow()
-            start_of_day = datetime(utcnow.year, utcnow.month, utcnow.day)
-            googlenow = start_of_day.isoformat() + "Z"  # 'Z' indicates UTC time
-
-            service = build("calendar", "v3", credentials=credentials)
-            events_result = (
-                service.events()
-                .list(
-                    calendarId="primary" and self.calendar_id,
-                    timeMin=googlenow,
-                    maxResults=howmany,
-                    singleEvents=True,
-                    orderBy="startTime",
-                )
-                .execute()
+        self.store_changes(items, sync_token, full)
+
+    def list_params(self, full):
+        params = dict(calendarId=self.calendar_id, singleEvents=True, maxResults=250)
+
+        if full:
+            sod = start_of_day()
+            params.update(
+                timeMin=sod.isoformat(),
+                timeMax=(sod + timedelta(days=settings.CALENDAR_SYNC_DAYS)).isoformat(),
             )
-        except RefreshError:
-            logger.exception("Refresh woes in slideshow")
-            return []
+        else:
+            params.update(syncToken=self.sync_token)
+
+        return params
+
+    def fetch_changes(self, service, full, result=None):
+        """
+        all pages of changes. result is the first page, if somebody fetched that already (see sync_calendars())
+        """
+        params = self.list_params(full)
+
+        items = []
+        while True:
+            if result is None:
+                result = service.events().list(**params).execute()
+
+            items.extend(result.get("items", []))
+            params["pageToken"] = result.get("nextPageToken")
+            if not params["pageToken"]:
+                return items, result.get("nextSyncToken", "")
+
+            result = None
+
+    @transaction.atomic
+    def store_changes(self, items, sync_token, full=False):
+        if full:
+            self.events.all().delete()
 
-        return events_result.get("items", [])
+        cancelled = [item["id"] for item in items if item.get("status") == "cancelled"]
+        if cancelled and not full:
+            self.events.filter(event_id__in=cancelled).delete()
 
+        for item in items:
+            if item.get("status") == "cancelled":
+                continue
+
+            start, end = CalendarEvent.parse_times(item)
+            fields = dict(start=start, end=end, data=item)
+            if full:
+                self.events.create(event_id=item["id"], **fields)
+            else:
+                self.events.update_or_create(event_id=item["id"], defaults=fields)
+
+        n = timezone.now()
+        self.sync_token = sync_token
+        self.last_sync = n
+        if full:
+            self.last_full_sync = n
+
+        self.save(update_fields=["sync_token", "last_sync", "last_full_sync"])
+
+    def load_events(self, howmany=30):
+        """
+        events from the local store, see sync_events()
+        """
+        return [
+            event.data
+            for event in self.events.filter(end__gt=start_of_day()).order_by("start")[:howmany]
+        ]
+
+
+class CalendarEvent(models.Model):
+    """
+    local copy of a google calendar event, kept up to date by CalendarConnection.sync_events()
+    """
+    calendar = models.ForeignKey(CalendarConnection, on_delete=models.CASCADE, related_name="events")
+    event_id = models.CharField(max_length=1024)
+
+    start = models.DateTimeField()
+    end = models.DateTimeField()
+
+    data = models.JSONField(default=dict)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["calendar", "event_id"], name="unique_calendar_event"),
+        ]
+        indexes = [
+            models.Index(fields=["calendar", "start"]),
+        ]
+
+    def __str__(self):
+        return f"Event {self.data.get('summary', '')} ({self.start})"
+
+    @staticmethod
+    def parse_times(item):
+        times = []
+        for key in ("start", "end"):
+            t = datetime.fromisoformat(item[key].get("dateTime", item[key].get("date")))
+            if not timezone.is_aware(t):
+                t = timezone.make_aware(t, timezone.utc)
+
+            times.append(t)
+
+        return times
+
+
+# the most calls google accepts in one batch request
+BATCH_SIZE = 50
+
+
+def sync_calendars(calendars):
+    """
+    like calling sync_events() on each calendar, but with one batch request per
+    google account (per BATCH_SIZE calendars) instead of one request per calendar. further pages and full
+    syncs after a 410 are fetched one by one.
+
+    returns {calendar pk: exception} for the calendars that failed.
+    """
+    by_user = collections.defaultdict(list)
+    for calendar in calendars:
+        by_user[calendar.user_id].append(calendar)
+
+    # google takes at most BATCH_SIZE calls per batch
+    batches = [
+        (user_id, user_calendars[i:i + BATCH_SIZE])
+        for user_id, user_calendars in by_user.items()
+        for i in range(0, len(user_calendars), BATCH_SIZE)
+    ]
+
+    errors = {}
+    for user_id, user_calendars in batches:
+        try:
+            credentials = get_credentials(user_id)
+            if credentials is None:
+                raise NoCredentials(f"user {user_id} has no google token")
+
+            service = calendar_service(credentials)
+            responses = {}
+
+            def collect(request_id, response, exception):
+                responses[request_id] = (response, exception)
+
+            batch = service.new_batch_http_request(callback=collect)
+            full = {}
+            for calendar in user_calendars:
+                full[calendar.pk] = calendar.full_sync_due()
+                batch.add(service.events().list(**calendar.list_params(full[calendar.pk])), request_id=str(calendar.pk))
+
+            batch.execute()
+        except Exception as e:
+            for calendar in user_calendars:
+                errors[calendar.pk] = e
+            continue
+
+        for calendar in user_calendars:
+            response, exception = responses.get(str(calendar.pk), (None, None))
+            try:
+                if isinstance(exception, HttpError) and exception.resp.status == 410 and not full[calendar.pk]:
+                    logger.info("sync token for %s expired, doing a full sync", calendar)
+                    calendar.sync_token = ""
+                    calendar.sync_events()
+                    continue
+
+                if exception is not None:
+                    raise exception
+
+                items, sync_token = calendar.fetch_changes(service, full[calendar.pk], result=response)
+                calendar.store_changes(items, sync_token, full[calendar.pk])
+            except Exception as e:
+                errors[calendar.pk] = e
+
+    return errors
+
+
+class RoomAlias(models.Model):
+    name = models.CharField("Name im Kalender", max_length=255, unique=True,
+                            help_text="So steht der Raum in den Kalender-Einträgen, Groß- und Kleinschreibung egal.")
+    alias = models.CharField("Anzeige", max_length=255, help_text="So wird der Raum auf dem Display angezeigt.")
+
+    class Meta:
+        verbose_name = "Raum"
+        verbose_name_plural = "Räume"
+        ordering = ["alias", "name"]
+
+    def __str__(self):
+        return f"Raum {self.name} ({self.alias})"
 
 
 class DisplayConfiguration(models.Model):
@@ -105,10 +292,56 @@ class DisplayConfiguration(models.Model):
 
     effect = models.CharField(choices=EFFECTS, default="", blank=True, max_length=1024)
 
+    modified = models.DateTimeField(auto_now=True)
+
     def __str__(self):
         return f"Display {self.name} ({self.title})"
 
 
+class AvailabilityRule(models.Model):
+    """
+    recurring times when somebody is around and the display stays on, e.g. the office hours of the gemeindebüro.
+    times are local (TIME_ZONE), so they stay put over the DST switch.
+    """
+    WEEKDAYS = [(1, "Montag"), (2, "Dienstag"), (3, "Mittwoch"), (4, "Donnerstag"), (5, "Freitag"), (6, "Samstag"), (7, "Sonntag")]
+
+    display = models.ForeignKey(DisplayConfiguration, on_delete=models.CASCADE, null=True, blank=True, related_name="availability_rules",
+                                help_text="Leer lassen, wenn die Zeit für alle Displays gilt.")
+    weekday = models.IntegerField("Wochentag", choices=WEEKDAYS)
+    start = models.TimeField("Von", help_text="Ortszeit (hh:mm)")
+    end = models.TimeField("Bis", help_text="Ortszeit (hh:mm)")
+
+    class Meta:
+        verbose_name = "Immer-an-Zeit"
+        verbose_name_plural = "Immer-an-Zeiten"
+        ordering = ["weekday", "start"]
+
+    def clean(self):
+        if self.start is not None and self.end is not None and self.end <= self.start:
+            raise ValidationError({"end": "Das Ende muss nach dem Anfang liegen."})
+
+    def __str__(self):
+        return f"{self.get_weekday_display()} {self.start:%H:%M}-{self.end:%H:%M} ({self.display or 'alle Displays'})"
+
+
+class AvailabilityException(models.Model):
+    """
+    days without the AvailabilityRules, holidays and such.
+    """
+    display = models.ForeignKey(DisplayConfiguration, on_delete=models.CASCADE, null=True, blank=True, related_name="availability_exceptions",
+                                help_text="Leer lassen, wenn der Tag für alle Displays gilt.")
+    date = models.DateField("Datum")
+    reason = models.CharField("Grund", max_length=255, blank=True, default="")
+
+    class Meta:
+        verbose_name = "Ausnahme von den Immer-an-Zeiten"
+        verbose_name_plural = "Ausnahmen von den Immer-an-Zeiten"
+        ordering = ["date"]
+
+    def __str__(self):
+        return f"{self.date:%d.%m.%Y} {self.reason} ({self.display or 'alle Displays'})"
+
+
 class DisplayConfigurationItem(models.Model):
     ITEMTYPES = [("banner", "Banner"), ("gottesdienste", "Gottesdienstplan"), ("kalender_countdown", "Countdown aus Kalender"), ("preview_events", "Ausblick"), ("next_events", "Nächste Ereignisse")]
 
@@ -126,6 +359,8 @@ class DisplayConfigurationItem(models.Model):
     banner = models.ForeignKey(ImageSlide, on_delete=models.CASCADE, null=True, blank=True)
     calendar = models.ForeignKey(CalendarConnection, on_delete=models.CASCADE, null=True, blank=True)
 
+    modified = models.DateTimeField(auto_now=True)
+
 
     def __str__(self):
         s = f"[{self.position}:{self.display}] {self.get_typ_display()}"
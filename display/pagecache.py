@@ -0,0 +1,199 @@
+"""
+Rendered displays in the cache, one group of keys per display.
+
+A page key contains the version of its display and the versions of the sources it
+shows. Saving or deleting a display, one of its items or one of its banners gives
+the display a new version (see display.signals), a source gets a new version when
+its data changes. Either way the next request builds a new page, the old ones are
+never asked for again and expire.
+
+Items and banners switch on and off by time, without anybody saving anything. A
+page is only kept until the next of these switches.
+
+When a page is missing, one request builds it, the others get the last good copy of
+that display (or wait for the new one, if there never was one). So a cold cache
+after a restart costs one build per display, not one per kiosk. The kiosks reload at
+different times as well: each display has its own slot in the refresh interval.
+"""
+import hashlib
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.timezone import now
+
+from display.models import DisplayConfiguration
+from display.sources import GOTTESDIENSTE_KEY, calendar_key_for, source_versions, version_key
+
+
+SLOTS_KEY = "pages:slots"
+# how long one request may take to build a page before others build it too
+BUILD_LOCK_TIMEOUT = 30
+# how long a request waits for a page somebody else builds, if there is no old one to show
+BUILD_WAIT = 5
+# the last good page of a display is kept this long, for serving while a new one is built
+LAST_GOOD_KEEP = 7 * 24 * 60 * 60
+
+
+def page_version_key(display_id):
+    return f"pages:version:{display_id}"
+
+
+def page_key(cfg, items, *variant):
+    """
+    the cache key of the page of cfg showing items, variant are things like portrait
+    """
+    version = cache.get(page_version_key(cfg.pk))
+    versions = sorted(source_versions(items).items())
+    digest = hashlib.sha1(repr((version, versions, variant)).encode()).hexdigest()
+    return f"pages:{cfg.pk}:{digest}"
+
+
+def last_good_key(cfg, *variant):
+    digest = hashlib.sha1(repr(variant).encode()).hexdigest()
+    return f"pages:{cfg.pk}:last:{digest}"
+
+
+def single_flight(key, fallback_key, build):
+    """
+    the cached value at key, built with build() -> (value, timeout) if it is missing.
+    only one caller builds, the others get the value at fallback_key: the last one
+    built, however old. returns the value and whether it is fresh, None if there is
+    nothing yet and somebody else is still building it after BUILD_WAIT seconds.
+    """
+    value = cache.get(key)
+    if value is not None:
+        return value, True
+
+    lock_key = f"{key}:building"
+    token = uuid.uuid4().hex
+    if not cache.add(lock_key, token, BUILD_LOCK_TIMEOUT):
+        value = cache.get(fallback_key)
+        if value is not None:
+            return value, False
+
+        # there is nothing to show yet, wait a bit for whoever builds it
+        delay = 0.1
+        deadline = time.monotonic() + BUILD_WAIT
+        while True:
+            if time.monotonic() + delay > deadline:
+                return None, False
+            time.sleep(delay)
+            delay = min(delay * 2, 1)
+
+            value = cache.get(key)
+            if value is not None:
+                return value, True
+            # the build failed, or took too long: try ourselves
+            if cache.add(lock_key, token, BUILD_LOCK_TIMEOUT):
+                break
+
+    try:
+        value, timeout = build()
+        cache.set(key, value, timeout)
+        cache.set(fallback_key, value, LAST_GOOD_KEEP)
+    finally:
+        # after BUILD_LOCK_TIMEOUT, the lock may belong to somebody else
+        if cache.get(lock_key) == token:
+            cache.delete(lock_key)
+
+    return value, True
+
+
+def refresh_slot(cfg):
+    """
+    (rank, count) of cfg among all displays, for spreading their refreshes evenly
+    """
+    slots = cache.get(SLOTS_KEY)
+    if slots is None:
+        pks = list(DisplayConfiguration.objects.order_by("name").values_list("pk", flat=True))
+        slots = {pk: (rank, len(pks)) for rank, pk in enumerate(pks)}
+        cache.set(SLOTS_KEY, slots, None)
+
+    return slots.get(cfg.pk, (0, 1))
+
+
+def jittered(cfg, seconds):
+    """
+    seconds, plus up to a fifth for the later displays. every display gets its own slot.
+    """
+    rank, count = refresh_slot(cfg)
+    return seconds + seconds // 5 * rank // count
+
+
+def forget_slots():
+    cache.delete(SLOTS_KEY)
+
+
+def forget_pages(display_ids):
+    """
+    the displays changed, build their pages again
+    """
+    cache.set_many({page_version_key(display_id): uuid.uuid4().hex for display_id in display_ids}, None)
+
+
+
+def next_change(cfg, n):
+    """
+    the next time an item or banner of cfg is switched on or off after n, None if nothing is planned.
+    """
+    times = []
+    for item in cfg.items.select_related("banner"):
+        times += [item.show_start, item.show_end]
+        if item.now_start is not None:
+            times += [item.now_start, item.now_start + item.how_long]
+        if item.banner is not None:
+            times += [item.banner.show_start, item.banner.show_end]
+
+    return min((t for t in times if t > n), default=None)
+
+
+def page_timeout(cfg):
+    """
+    how long the page of cfg may be cached: PAGE_CACHE_TIMEOUT, or until the next change of its items.
+    """
+    n = now()
+    timeout = settings.PAGE_CACHE_TIMEOUT
+    change = next_change(cfg, n)
+    if change is not None:
+        # one second late, so the next page is built after the switch
+        timeout = min(timeout, int((change - n).total_seconds()) + 1)
+
+    return timeout
+
+
+def page_etag(cfg, *variant):
+    """
+    a strong ETag for the page of cfg, from one query over its items and the source versions in the cache.
+    cheap enough to answer If-None-Match before anything is rendered.
+    """
+    n = now()
+    rows = list(cfg.items.values_list(
+        "pk", "typ", "calendar_id", "modified", "banner__modified",
+        "show_start", "show_end", "now_start", "how_long", "banner__show_start", "banner__show_end",
+    ))
+
+    keys = set()
+    state = [cfg.pk, cfg.modified, variant]
+    for pk, typ, calendar_id, modified, banner_modified, show_start, show_end, now_start, how_long, banner_start, banner_end in rows:
+        active = show_start < n < show_end
+        state.append((
+            pk, modified, banner_modified, active,
+            now_start is not None and now_start < n < now_start + how_long,
+            banner_start is not None and banner_start < n < banner_end,
+        ))
+        if not active:
+            continue
+
+        if typ == "gottesdienste":
+            keys.add(GOTTESDIENSTE_KEY)
+        elif calendar_id:
+            keys.add(calendar_key_for(calendar_id))
+        if typ == "kalender_countdown":
+            # the countdown counts down by itself
+            state.append(n.replace(second=0, microsecond=0))
+
+    versions = cache.get_many([page_version_key(cfg.pk)] + [version_key(key) for key in sorted(keys)])
+    state.append(sorted(versions.items()))
+    return hashlib.sha1(repr(state).encode()).hexdigest()
@@ -0,0 +1,196 @@
+"""
+Reading the calendar entries: markers like ⏰ or [pre] and the room hidden in the summary.
+
+Recurring events bring the same summaries over and over, so parse_summary() remembers
+its results. The known rooms come from the RoomAlias table and are compiled into one
+regex, which is only rebuilt when the table changes.
+"""
+import collections
+import functools
+import logging
+import re
+import uuid
+
+from django.core.cache import cache
+from django.core.mail import mail_admins
+
+from display.models import RoomAlias
+
+logger = logging.getLogger(__name__)
+
+Summary = collections.namedtuple("Summary", "summary room preview special jugend hidden")
+
+MARKERS = {
+    "⏰": "preview",
+    "[pre]": "preview",
+    "🎉": "special",
+    "[codo]": "special",
+    "🚸": "jugend",
+    "[evj]": "jugend",
+    "👻": "hidden",
+    "[intern]": "hidden",
+}
+MARKERS_RE = re.compile("|".join(re.escape(marker) for marker in MARKERS))
+
+ROOMS_VERSION_KEY = "parsing:rooms:version"
+
+_rooms = (None, None)  # version, RoomMatcher
+
+
+class RoomMatcher:
+    """
+    finds the longest known room name in a calendar entry, with one compiled regex.
+    """
+
+    def __init__(self, rooms):
+        # lower case name: (pattern to remove it, alias)
+        self.rooms = {
+            name.lower(): (re.compile(re.escape(name), re.IGNORECASE), alias)
+            for name, alias in rooms
+        }
+        names = sorted(self.rooms, key=len, reverse=True)
+        self.regex = re.compile("|".join(re.escape(name) for name in names), re.IGNORECASE) if names else None
+
+    def find(self, eintrag):
+        """
+        (pattern, alias) of the longest room name in eintrag, None if there is none.
+        """
+        if self.regex is None:
+            return None
+
+        m = max(self.regex.finditer(eintrag), key=lambda m: len(m.group(0)), default=None)
+        if m is None:
+            return None
+
+        return self.rooms[m.group(0).lower()]
+
+
+def room_matcher():
+    """
+    the RoomMatcher for the current RoomAlias table. only rebuilt after the table changed.
+    """
+    global _rooms
+
+    version = cache.get(ROOMS_VERSION_KEY)
+    built_for, matcher = _rooms
+    if matcher is None or built_for != version:
+        matcher = RoomMatcher(RoomAlias.objects.values_list("name", "alias"))
+        _rooms = (version, matcher)
+
+    return matcher
+
+
+def forget_room_matcher():
+    """
+    RoomAlias changed, every process has to rebuild its matcher
+    """
+    global _rooms
+    cache.set(ROOMS_VERSION_KEY, uuid.uuid4().hex, None)
+    _rooms = (None, None)
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_summary(summary, rooms):
+    """
+    flags, room and clean summary of a calendar entry in one go. rooms is a RoomMatcher.
+    """
+    flags = set()
+
+    def marker(m):
+        flags.add(MARKERS[m.group(0)])
+        return ""
+
+    summary = MARKERS_RE.sub(marker, summary)
+
+    room = ""
+    if "hidden" not in flags:
+        try:
+            summary, room = massage_kalendereintrag(summary, rooms)
+        except Exception as e:
+            mail_admins("massage_kalendereintrag ist unglücklich", str(e), fail_silently=True)
+            logger.exception("massage_kalendereintrag ist unglücklich")
+            room = ""
+
+    return Summary(summary, room, "preview" in flags, "special" in flags, "jugend" in flags, "hidden" in flags)
+
+
+def massage_kalendereintrag(eintrag, rooms=None):
+    """
+    try and decipher the kalendereintrag. return "Summary", "Room"
+
+    Should be:
+
+    Room @ Event
+
+    But often it's not.
+
+    i.e.
+
+    @Sonnengruppenraum:Pekip -> "Pekip", "Sonnengruppenraum"
+
+    @Mukiraum: CKU Pilates 18-19Uhr -> "CKU Pilates 18-19Uhr", "Mukiraum"
+
+    1/3 Saal@KU
+    DienstgespÃ¤ch HAMA @ GemeindebÃ¼ro
+    2/3 Saal@Frauenhilfe
+    @1/3 Saal: Franz. Kurs
+    @Mukiraum: CKU Pilates 18-19Uhr
+    3/3 Saal @ WirbelsÃ¤ulengymnastik
+    KU@Saal
+    1/3 Saal@Bastelkreis
+    2/3 Saal@Seniorenkreis
+    JugendrÃ¤ume@FreakyFriday
+    MuKiraum @ TagesmÃ¼tter
+    1/3 Saal @ Dienstagsfrauen
+    1/3 Saal@ Jugend MAGK
+    9-12.15 h PEKiP / CKU SonnengrupRraum
+    3/3 Saal @ Gymnastik
+    2/3 Saal @ Posaunenchor
+    MuKiRaum @ PEKIP/ CKU
+    Yoga Kurs @ 1/3 Saal
+    MuKiRaum@RÃ¼ckbildungsgymnastik
+    Saal 1/3@Geburtsvorbereitungskurs
+    @Sonnengruppenraum:Pekip
+    1/3Saal @ Cafe Knirps
+    """
+    eintrag = eintrag.strip()
+
+    if len(eintrag) < 5:
+        # generate complaint?
+        return eintrag
+
+    if rooms is None:
+        rooms = room_matcher()
+
+    room = ""
+    summary = eintrag
+
+    found = rooms.find(eintrag)
+    if found:
+        # we found a known room.
+        pattern, alias = found
+        room = alias
+        s = pattern.sub("", eintrag)
+        s = s.replace("@", "").strip()
+        if s[0] == ":":
+            s = s[1:]
+
+        if s[-1] == ":":
+            s = s[:-1]
+
+        summary = s.strip()
+
+    if not room and "@" in eintrag:
+        if eintrag[0] == "@" and ":" in eintrag:
+            lhs, rhs = eintrag[1:].split(":")
+        else:
+            lhs, rhs = eintrag.split("@")
+
+        room = lhs.strip()
+        summary = rhs.strip()
+
+
+    if summary:
+        return summary, room
+    else: # FIXME: add complaints department?
+        return eintrag, ""
@@ -0,0 +1,141 @@
+"""
+Server-sent events for the displays: a message whenever what a display shows changed,
+the slideshow then fetches its data.json.
+
+Under ASGI every process runs one poller for all its connections. Every PUSH_INTERVAL
+seconds it computes a fingerprint of each display somebody listens to: the page
+version (saving a display, item or banner), the versions of its sources (new calendar
+data) and the next time an item switches. Only a changed fingerprint wakes up the
+connections of that display, an idle connection is a sleeping coroutine.
+
+Under WSGI a connection would block a worker thread, so there the stream is just the
+current fingerprint and a retry of PUSH_WSGI_RETRY seconds: plain polling. That's why
+uwsgi.ini passes the events route on to uvicorn and everything else stays with uwsgi.
+"""
+import asyncio
+import collections
+import hashlib
+import logging
+import os
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.timezone import now
+
+from display.models import DisplayConfiguration
+from display.pagecache import next_change, page_version_key
+from display.sources import source_versions
+
+logger = logging.getLogger(__name__)
+
+PROCESSES_KEY = "push:processes"
+
+_subscribers = collections.defaultdict(set)  # display id -> queues
+_known = {}  # display id -> the fingerprint its connections got last
+_poller = None
+
+
+def fingerprint(cfg):
+    items = list(cfg.items.select_related("calendar"))
+    state = (cache.get(page_version_key(cfg.pk)), sorted(source_versions(items).items()), next_change(cfg, now()))
+    return hashlib.sha1(repr(state).encode()).hexdigest()
+
+
+def fingerprints(display_ids):
+    return {cfg.pk: fingerprint(cfg) for cfg in DisplayConfiguration.objects.filter(pk__in=display_ids)}
+
+
+def message(data, retry=None):
+    lines = []
+    if retry is not None:
+        lines.append(f"retry: {int(retry * 1000)}")
+    lines.append(f"data: {data}")
+    return "\n".join(lines) + "\n\n"
+
+
+def connections_key(pid=None):
+    return f"push:connections:{pid or os.getpid()}"
+
+
+def publish_counts():
+    """
+    the connections of this process, for the wartungsklappe
+    """
+    counts = {display_id: len(queues) for display_id, queues in _subscribers.items() if queues}
+    cache.set(connections_key(), counts, settings.PUSH_INTERVAL * 5)
+
+    processes = cache.get(PROCESSES_KEY) or []
+    if os.getpid() not in processes:
+        cache.set(PROCESSES_KEY, processes[-20:] + [os.getpid()], None)
+
+
+def connection_counts():
+    """
+    {display id: open connections} over all processes
+    """
+    processes = cache.get(PROCESSES_KEY) or []
+    totals = collections.Counter()
+    for counts in cache.get_many([connections_key(pid) for pid in processes]).values():
+        totals.update(counts)
+    return dict(totals)
+
+
+async def poll():
+    global _poller
+
+    while any(_subscribers.values()):
+        try:
+            current = await sync_to_async(fingerprints)([pk for pk, queues in _subscribers.items() if queues])
+            await sync_to_async(publish_counts)()
+        except Exception:
+            logger.exception("push poller failed, trying again")
+            current = {}
+
+        for display_id, value in current.items():
+            if _known.get(display_id) != value:
+                _known[display_id] = value
+                for queue in _subscribers[display_id]:
+                    queue.put_nowait(value)
+
+        await asyncio.sleep(settings.PUSH_INTERVAL)
+
+    # nobody listens anymore. without an await in between, the next stream() starts a new poller
+    _poller = None
+    await sync_to_async(publish_counts)()
+
+
+async def stream(cfg):
+    """
+    the events for cfg, ends after PUSH_MAX_AGE seconds and the browser connects again.
+    that also cleans up after browsers which went away without us noticing.
+    """
+    global _poller
+
+    value = await sync_to_async(fingerprint)(cfg)
+
+    # the poller only sends what differs from this, not the first message again
+    queue = asyncio.Queue()
+    _subscribers[cfg.pk].add(queue)
+    _known.setdefault(cfg.pk, value)
+    if _poller is None:
+        _poller = asyncio.ensure_future(poll())
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + settings.PUSH_MAX_AGE
+    try:
+        yield message(value, retry=settings.PUSH_INTERVAL)
+
+        while loop.time() < deadline:
+            try:
+                value = await asyncio.wait_for(queue.get(), timeout=min(30, max(0.0, deadline - loop.time())))
+            except asyncio.TimeoutError:
+                # keeps proxies from closing the connection
+                yield ": ping\n\n"
+            else:
+                yield message(value)
+    finally:
+        _subscribers[cfg.pk].discard(queue)
+        if not _subscribers[cfg.pk]:
+            # a later connection would get an outdated fingerprint again
+            _known.pop(cfg.pk, None)
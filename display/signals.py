@@ -0,0 +1,36 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from display.availability import forget_availability
+from display.models import AvailabilityException, AvailabilityRule, RoomAlias, DisplayConfiguration, \
+    DisplayConfigurationItem, ImageSlide
+from display.pagecache import forget_pages, forget_slots
+from display.parsing import forget_room_matcher
+
+
+@receiver([post_save, post_delete], sender=RoomAlias)
+def rooms_changed(sender, **kwargs):
+    forget_room_matcher()
+
+
+@receiver([post_save, post_delete], sender=AvailabilityRule)
+@receiver([post_save, post_delete], sender=AvailabilityException)
+def availability_changed(sender, **kwargs):
+    forget_availability()
+
+
+@receiver([post_save, post_delete], sender=DisplayConfiguration)
+def display_changed(sender, instance, **kwargs):
+    forget_pages([instance.pk])
+    forget_slots()
+
+
+@receiver([post_save, post_delete], sender=DisplayConfigurationItem)
+def item_changed(sender, instance, **kwargs):
+    forget_pages([instance.display_id])
+
+
+@receiver([post_save, post_delete], sender=ImageSlide)
+def banner_changed(sender, instance, **kwargs):
+    # after a delete the items are gone already, they took care of their displays
+    forget_pages(set(DisplayConfigurationItem.objects.filter(banner=instance).values_list("display_id", flat=True)))
@@ -0,0 +1,542 @@
+"""
+Everything the displays show that comes from elsewhere: calendar events and the
+Gottesdienst plan from kirche-froemern.de.
+
+The parsed results are kept in the cache. The prefetch management command keeps
+them fresh, so rendering a display only reads from the cache. Without it running,
+whoever misses the cache fetches.
+
+When a source fails, the last good result is served and the failure is remembered
+together with the time of the next try, backing off exponentially.
+"""
+import collections
+import hashlib
+import itertools
+import logging
+import os
+import pickle
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import timedelta, datetime
+
+from bs4 import BeautifulSoup, SoupStrainer
+from django.conf import settings
+from django.core.cache import cache
+from django.core.mail import mail_admins
+from django.db import connection
+from django.utils import timezone
+from django.utils.timezone import now, make_aware, is_aware
+
+from display import http
+from display.models import CalendarConnection, start_of_day, sync_calendars
+from display.parsing import parse_summary, room_matcher
+from display.timeline import EventIndex
+
+Event = collections.namedtuple("Event", "start end summary allday jugend room")
+# what load_events() returns. index and today_index are EventIndex of all and of today's events.
+CalendarData = collections.namedtuple(
+    "CalendarData",
+    "today_events next_event current_event next_events preview_events special_event index today_index",
+)
+
+logger = logging.getLogger(__name__)
+
+GOTTESDIENSTE_KEY = "sources:gottesdienste"
+GOTTESDIENSTE_URL = "https://www.kirche-froemern.de/gruppen-angebote/gottesdienste"
+
+# failing sources are retried after RETRY_MIN, doubling up to RETRY_MAX.
+RETRY_MIN = timedelta(minutes=1)
+RETRY_MAX = timedelta(hours=1)
+# the last good result is kept this long, to show something during outages.
+SOURCE_KEEP = timedelta(days=7)
+# one process refreshes a source at a time, unless it takes longer than this many seconds
+REFRESH_LOCK_TIMEOUT = 120
+
+# what load_events() would say about an empty calendar
+NO_EVENTS = CalendarData([], None, None, [], [], None, EventIndex([]), EventIndex([]))
+
+# about twice as fast as html.parser, see the benchmark_gottesdienste command
+HTML_PARSER = "lxml"
+
+# month and weekday names for parse_german_date(), so the scraper does not depend on the locale
+GERMAN_MONTHS = {}
+for number, name in enumerate(["Januar", "Februar", "März", "April", "Mai", "Juni", "Juli", "August", "September",
+                               "Oktober", "November", "Dezember"], start=1):
+    GERMAN_MONTHS[name.lower()] = GERMAN_MONTHS[name[:3].lower()] = number
+GERMAN_MONTHS.update({"maerz": 3, "sept": 9})
+
+GERMAN_WEEKDAYS = {}
+for number, name in enumerate(["Montag", "Dienstag", "Mittwoch", "Donnerstag", "Freitag", "Samstag", "Sonntag"], start=1):
+    GERMAN_WEEKDAYS[name.lower()] = GERMAN_WEEKDAYS[name[:2].lower()] = number
+GERMAN_WEEKDAYS["sonnabend"] = 6
+
+GERMAN_DATE_RE = re.compile(r"\s*(?:([^\W\d_]+)\.?,?\s+)?(\d{1,2})\.\s*([^\W\d_]+)\.?\s*$")
+
+_executor = ThreadPoolExecutor(max_workers=settings.SOURCE_WORKERS, thread_name_prefix="sources")
+_running = {}  # key -> future of the refresh running in this process
+_running_lock = threading.Lock()
+
+
+def calendar_key(calendar):
+    return calendar_key_for(calendar.pk)
+
+
+def calendar_key_for(calendar_id):
+    # v2: load_events() returns CalendarData
+    return f"sources:calendar:v2:{calendar_id}"
+
+
+def parse_german_date(text):
+    """
+    "4. Oktober" -> (4, 10), like time.strptime(text, "%d. %B") in a german locale, but without one.
+    abbreviated months and a weekday in front ("So, 4. Okt.") are fine as well. raises ValueError.
+    """
+    match = GERMAN_DATE_RE.match(text)
+    if match is None:
+        raise ValueError(f"not a german date: {text!r}")
+
+    weekday, day, month = match.groups()
+    if weekday and weekday.lower() not in GERMAN_WEEKDAYS:
+        raise ValueError(f"not a german weekday: {weekday!r}")
+
+    month = GERMAN_MONTHS.get(month.lower())
+    if month is None:
+        raise ValueError(f"not a german month: {text!r}")
+
+    day = int(day)
+    # a leap year, the 29th of february is fine
+    datetime(2000, month, day)
+    return day, month
+
+
+def scrape_gottesdienste(validators=None):
+    """
+    download the Gottesdienst plan, conditionally if there are validators from last time.
+    returns the events, or None if the page did not change, and the validators for next time.
+    """
+    headers = {}
+    if validators and validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators and validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+
+    r = http.get(GOTTESDIENSTE_URL, headers=headers)
+    if r.status_code == 304:
+        return None, validators
+
+    r.raise_for_status()
+    validators = dict(etag=r.headers.get("ETag"), last_modified=r.headers.get("Last-Modified"))
+    return parse_gottesdienste(r.text), validators
+
+
+def parse_gottesdienste(html, parser=HTML_PARSER):
+    gottesdienste = []
+
+    # only the tables are built into a tree, the rest of the page is skipped while parsing
+    soup = BeautifulSoup(html, parser, parse_only=SoupStrainer("table", class_="contenttable"))
+
+    for table in soup.find_all("table", class_="contenttable"):
+        rows = [row.find_all("td") for row in table.find_all("tr")]
+        if not rows:
+            continue
+
+        if len(rows[0]) == 4: # multi table
+            orte = []
+            for cells in rows:
+                if len(cells) < 4:
+                    continue
+
+                if not orte:
+                    orte.append("")
+                    for col in cells:
+                        t = col.get_text().strip()
+                        if t:
+                            orte.append(t.strip())
+
+                    continue
+
+                day = None
+                untertitel = ""
+                for ort, col in zip(orte, cells):
+
+                    try:
+                        p_elements = col.find_all("p")
+                        if not ort:
+                            datum = p_elements[0].get_text().strip()
+                            untertitel = " ".join(e.get_text().strip() for e in p_elements[1:])
+                            day = parse_german_date(datum)
+
+                        else:
+                            uhrzeit = p_elements[0].get_text().strip()
+                            titel = " ".join(e.get_text().strip() for e in p_elements[1:])
+                            uhrzeit = time.strptime(uhrzeit, "%H:%M")
+                            date = datetime.utcnow().replace(day=day[0], month=day[1], hour=uhrzeit.tm_hour, minute=uhrzeit.tm_min, second=0)
+                            make_aware(date)
+                            gottesdienste.append(Event(date, date, titel, False, False, f"{ort} ({untertitel})"))
+
+
+
+                    except ValueError:
+                        continue # skip if broken
+
+
+        else:
+
+            for (date, thetime), (sonntag, beschreibung) in itertools.pairwise(rows):
+                date = date.get_text()
+                thetime = thetime.get_text()
+
+                monate = dict(Jan=1, Feb=2, Mar=3, Apr=4, Mai=5, Jun=6, Jul=7, Aug=8, Sep=9, Okt=10, Nov=11, Dez=12)
+                month = None
+                for monat, imonat in monate.items():
+                    if monat in date:
+                        month = imonat
+
+                if month is None:
+                    continue
+
+                day = int(re.sub(r"[^0-9]", "", date))
+
+                if not ":" in thetime:
+                    continue
+
+                hour,minute = thetime.split(":")
+
+                hour = int(hour)
+                minute = int(minute)
+
+                start = datetime.utcnow().replace(month=month, day=day, hour=hour, minute=minute, second=0,microsecond=0)
+                start = make_aware(start)
+
+                if start < start_of_day():
+                    continue
+
+
+                gottesdienste.append(Event(start, start, beschreibung.get_text(), False, False, sonntag.get_text()))
+
+
+    return gottesdienste[:8]
+
+
+
+
+
+def load_events(calcfg):
+    n = now()
+    start_of_day = n.replace(hour=0, minute=0, second=0)
+    end_of_day = n.replace(hour=23, minute=59, second=59)
+
+    parsed_events = []
+    preview_candidates = []
+    special_event = None
+    events = calcfg.load_events()
+    rooms = room_matcher()
+
+    for event in events:
+        start = event["start"].get("dateTime", event["start"].get("date"))
+        end = event["end"].get("dateTime", event["end"].get("date"))
+
+        allday = not "dateTime" in event["start"]
+
+        parsed = parse_summary(event.get("summary", ""), rooms)
+        if parsed.hidden:
+            continue
+
+        summary, room = parsed.summary, parsed.room
+        is_jugend = parsed.jugend or room == "Jugendräume"  # temporary special case?!
+
+        start = datetime.fromisoformat(start)
+        end = datetime.fromisoformat(end)
+
+        if not is_aware(start):
+            start = make_aware(start, timezone.utc)
+
+        if not is_aware(end):
+            end = make_aware(end, timezone.utc)
+
+        data = Event(start, end, summary, allday, is_jugend, room)
+        parsed_events.append(data)
+
+        if parsed.preview:
+            preview_candidates.append(data)
+
+        if parsed.special and not special_event:
+            special_event = data
+
+    index = EventIndex(parsed_events)
+
+    # was geht heute so? (Auch Vergangenes)
+    today_events = index.starting_between(start_of_day, end_of_day)
+    # nächstes Ereignis das in der nächsten Stunde startet.
+    next_event = index.last_starting_between(n, n + timedelta(hours=1))
+    # letztes Ereignis, wenn es  in der letzten Stunde startete.
+    current_event = index.last_starting_between(n - timedelta(hours=1), n, include_end=False)
+
+    next_events = []  # die nächsten fünf Events
+    for data in index.starting_between(end_of_day, n + timedelta(days=30)):
+        if len(next_events) < 6 or next_events[-1].start.day == data.start.day:
+            # inlcude max 6 events but always finish the day
+            next_events.append(data)
+
+    # speziell markierte vorschau events
+    preview_events = [
+        data
+        for data in preview_candidates
+        if data not in today_events and data not in next_events
+    ]
+
+    return CalendarData(today_events, next_event, current_event, next_events, preview_events, special_event,
+                        index, EventIndex(today_events))
+
+
+def new_state():
+    return dict(value=None, checked=None, fetched=None, error="", failures=0, retry=None)
+
+
+def load_state(key):
+    return cache.get(key) or new_state()
+
+
+def save_state(key, state):
+    # the version changes with the value, so pages built from it know when they are outdated
+    version = hashlib.sha1(pickle.dumps(state["value"])).hexdigest()
+    cache.set_many({key: state, version_key(key): version}, SOURCE_KEEP.total_seconds())
+
+
+def version_key(key):
+    return f"{key}:version"
+
+
+def source_keys(items):
+    """
+    the keys of the sources items show
+    """
+    keys = []
+    for item in items:
+        if item.typ == "gottesdienste":
+            keys.append(GOTTESDIENSTE_KEY)
+        elif item.calendar:
+            keys.append(calendar_key(item.calendar))
+
+    return sorted(set(keys))
+
+
+def source_versions(items):
+    """
+    {key: version} of the sources items show, None for the ones never fetched
+    """
+    keys = source_keys(items)
+    versions = cache.get_many([version_key(key) for key in keys])
+    return {key: versions.get(version_key(key)) for key in keys}
+
+
+def may_retry(state):
+    return state["retry"] is None or state["retry"] <= now()
+
+
+def is_fresh(state):
+    # a source can keep its results longer, unless it is failing
+    max_age = (not state["failures"] and state.get("max_age")) or settings.PREFETCH_TIMEOUT
+    return state["checked"] is not None and state["checked"] + timedelta(seconds=max_age) > now()
+
+
+def record_success(state):
+    n = now()
+    state.update(checked=n, fetched=n, error="", failures=0, retry=None)
+
+
+def record_failure(state, label, e):
+    """
+    keep the last good value, but don't try again before the backoff is over.
+    """
+    n = now()
+    failures = state["failures"] + 1
+    backoff = min(RETRY_MIN * 2 ** (failures - 1), RETRY_MAX)
+    state.update(checked=n, error=f"{e.__class__.__name__}: {e}", failures=failures, retry=n + backoff)
+
+    logger.error("%s failed %d times, next try at %s", label, failures, state["retry"], exc_info=e)
+    if failures == 1:
+        mail_admins(f"{label} nicht so gut", state["error"], fail_silently=True)
+
+
+def refresh_calendar(calendar):
+    """
+    sync calendar with google (if due and not backing off) and parse its events from the local store.
+    if google is not reachable, this just shows what we got last time.
+    """
+    key = calendar_key(calendar)
+    state = load_state(key)
+
+    if may_retry(state) and calendar.sync_due():
+        try:
+            calendar.sync_events()
+        except Exception as e:
+            record_failure(state, str(calendar), e)
+        else:
+            record_success(state)
+    else:
+        state["checked"] = now()
+
+    state["value"] = load_events(calendar)
+    save_state(key, state)
+    return state["value"]
+
+
+def refresh_calendars(calendars):
+    """
+    refresh_calendar() for many calendars at once, the due ones are synced in batches.
+    """
+    calendars = list(calendars)
+    states = cache.get_many([calendar_key(calendar) for calendar in calendars])
+    states = {calendar.pk: states.get(calendar_key(calendar)) or new_state() for calendar in calendars}
+
+    due = [calendar for calendar in calendars if may_retry(states[calendar.pk]) and calendar.sync_due()]
+    errors = sync_calendars(due)
+
+    results = {}
+    for calendar in calendars:
+        state = states[calendar.pk]
+        if calendar.pk in errors:
+            record_failure(state, str(calendar), errors[calendar.pk])
+        elif calendar in due:
+            record_success(state)
+        else:
+            state["checked"] = now()
+
+        state["value"] = results[calendar.pk] = load_events(calendar)
+        save_state(calendar_key(calendar), state)
+
+    return results
+
+
+def refresh_gottesdienste():
+    """
+    the parsed gottesdienste, fresh for GOTTESDIENSTE_MAX_AGE. after that the page is checked
+    with a conditional request, and only parsed again if it changed.
+    """
+    state = load_state(GOTTESDIENSTE_KEY)
+    state["max_age"] = settings.GOTTESDIENSTE_MAX_AGE
+
+    if may_retry(state) and not (state["value"] is not None and is_fresh(state)):
+        # the parse drops past events, so once a day it has to run anyway
+        validators = state.get("validators") if state.get("parsed_on") == start_of_day() else None
+
+        try:
+            value, state["validators"] = scrape_gottesdienste(validators)
+        except Exception as e:
+            record_failure(state, "scrape_gottesdienste()", e)
+        else:
+            if value is not None:
+                state["value"] = value
+                state["parsed_on"] = start_of_day()
+            record_success(state)
+
+        save_state(GOTTESDIENSTE_KEY, state)
+
+    return state["value"] or []
+
+
+def run_closing_connection(fn, *args):
+    try:
+        return fn(*args)
+    finally:
+        # runs outside of the request cycle, nobody else closes this thread's connection
+        connection.close()
+
+
+def refresh_lock_key(key):
+    return f"{key}:refreshing"
+
+
+def run_refresh(key, fn, *args):
+    try:
+        return run_closing_connection(fn, *args)
+    finally:
+        with _running_lock:
+            del _running[key]
+        cache.delete(refresh_lock_key(key))
+
+
+def submit_refresh(key, fn, *args):
+    """
+    the future of the refresh of key: the one running in this process already, or a new one.
+    None if another process is refreshing it.
+    """
+    with _running_lock:
+        future = _running.get(key)
+        if future is None:
+            if not cache.add(refresh_lock_key(key), os.getpid(), REFRESH_LOCK_TIMEOUT):
+                return None
+            future = _running[key] = _executor.submit(run_refresh, key, fn, *args)
+
+    return future
+
+
+def fetch_all(items, timeout=None):
+    """
+    everything the display items need from outside, fetched in parallel.
+
+    returns {calendar pk: load_events() tuple, GOTTESDIENSTE_KEY: events}. whatever is
+    not fresh in the cache is refreshed on the thread pool. sources that take longer
+    than timeout or fail give their last good result, they finish in the background and
+    are fresh next time. without a last good result they are left out.
+
+    a source is only refreshed once at a time: requests in this process wait for the same
+    refresh, while another process refreshes it they get the last good result.
+    """
+    if timeout is None:
+        timeout = settings.SOURCE_TIMEOUT
+
+    jobs = {}
+    for item in items:
+        if item.typ == "gottesdienste":
+            jobs[GOTTESDIENSTE_KEY] = (refresh_gottesdienste,)
+        elif item.calendar:
+            jobs[calendar_key(item.calendar)] = (refresh_calendar, item.calendar)
+
+    results = {}
+    states = cache.get_many(jobs)
+    for key, state in states.items():
+        if state["value"] is not None and is_fresh(state):
+            results[key] = state["value"]
+            del jobs[key]
+
+    def last_good(key):
+        if key in states and states[key]["value"] is not None:
+            results[key] = states[key]["value"]
+
+    futures = {}
+    for key, job in jobs.items():
+        future = submit_refresh(key, *job)
+        if future is not None:
+            futures[future] = key
+        else:
+            last_good(key)
+
+    done, not_done = wait(futures, timeout=timeout)
+
+    for future in done:
+        try:
+            results[futures[future]] = future.result()
+        except Exception:
+            logger.exception("fetching %s failed", futures[future])
+            last_good(futures[future])
+
+    for future in not_done:
+        logger.warning("%s took longer than %s seconds, going with the last good result", futures[future], timeout)
+        last_good(futures[future])
+
+    return results
+
+
+def source_states():
+    """
+    (name, state) for every source, for the wartungsklappe.
+    """
+    sources = [(str(calendar), calendar_key(calendar)) for calendar in CalendarConnection.objects.all()]
+    sources.append(("Gottesdienste", GOTTESDIENSTE_KEY))
+
+    states = cache.get_many([key for name, key in sources])
+    return [(name, states.get(key) or new_state()) for name, key in sources]
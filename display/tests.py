@@ -1,3 +1,842 @@
-from django.test import TestCase
+import asyncio
+import importlib
+import io
+import tempfile
+import threading
+import time
+from datetime import date, datetime, time as daytime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils.cache import get_max_age
+from django.utils.timezone import now
+from google.oauth2.credentials import Credentials
+from googleapiclient.errors import HttpError
+from httplib2 import Response
+from PIL import Image
+
+from display import push
+from display.availability import Availability, availability
+from display.gcal import refresh_single_flight
+from display.models import CalendarConnection, DisplayConfiguration, DisplayConfigurationItem, ImageSlide, \
+    start_of_day, sync_calendars
+from display.pagecache import page_version_key, single_flight
+from display.parsing import RoomMatcher, massage_kalendereintrag
+from display.sources import GOTTESDIENSTE_KEY, NO_EVENTS, calendar_key, fetch_all, new_state, parse_gottesdienste, \
+    refresh_calendar, refresh_calendars, save_state
+from display.timeline import Timeline
+from display.views import presentation_context, presentation_timeout
+
+TESTDATA = Path(__file__).resolve().parent / "testdata"
+
+
+class ParseGottesdiensteTest(SimpleTestCase):
+    """
+    saved copies of both layouts of the Gottesdienst page
+    """
+
+    def parse(self, name, parser="lxml"):
+        html = (TESTDATA / name).read_text()
+        # nothing is in the past
+        with mock.patch("display.sources.start_of_day", return_value=datetime(2000, 1, 1, tzinfo=timezone.utc)):
+            return [
+                (event.start.month, event.start.day, event.start.hour, event.start.minute, event.summary, event.room)
+                for event in parse_gottesdienste(html, parser)
+            ]
+
+    def test_parsers_agree(self):
+        for name in ("gottesdienste_multi.html", "gottesdienste_zweizeilig.html"):
+            with self.subTest(name=name):
+                self.assertEqual(self.parse(name, "html.parser"), self.parse(name))
+
+    def test_multi_column(self):
+        self.assertEqual(self.parse("gottesdienste_multi.html"), [
+            (10, 4, 10, 0, "Familiengottesdienst zu Erntedank", "Frömern (Erntedank)"),
+            (10, 4, 11, 15, "Gottesdienst", "Strickherdicke (Erntedank)"),
+            (10, 11, 10, 0, "Gottesdienst mit Abendmahl", "Frömern (17. Sonntag nach Trinitatis)"),
+            (10, 11, 11, 15, "Gottesdienst", "Ostbüren (17. Sonntag nach Trinitatis)"),
+            (10, 18, 10, 0, "Gottesdienst", "Frömern (18. Sonntag nach Trinitatis)"),
+            (10, 25, 10, 0, "Regionaler Gottesdienst", "Ostbüren (19. Sonntag nach Trinitatis)"),
+            (10, 31, 18, 0, "Gottesdienst zum Reformationstag", "Frömern (Reformationstag)"),
+            (11, 1, 10, 0, "Gottesdienst", "Frömern (20. Sonntag nach Trinitatis)"),
+        ])
+
+    def test_two_rows(self):
+        self.assertEqual(self.parse("gottesdienste_zweizeilig.html"), [
+            (10, 18, 10, 0, "Gottesdienst", "18. Sonntag n. Trinitatis"),
+            (10, 25, 10, 0, "Gottesdienst mit Abendmahl", "19. Sonntag n. Trinitatis"),
+            (10, 31, 18, 0, "Gottesdienst zum Reformationstag", "Reformationstag"),
+            (11, 1, 10, 0, "Gottesdienst mit Taufen", "20. Sonntag n. Trinitatis"),
+            (11, 15, 11, 15, "Gottesdienst mit Kranzniederlegung", "Volkstrauertag"),
+        ])
+
+
+ROOMS = [
+    ("Saal", "Saal"),
+    ("1/3 Saal", "Saal (1/3)"),
+    ("Saal 1/3", "Saal (1/3)"),
+    ("2/3 Saal", "Saal (2/3)"),
+    ("Mukiraum", "MuKi-Raum"),
+    ("Sonnengruppenraum", "Sonnengruppenraum"),
+]
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class RefreshSingleFlightTest(SimpleTestCase):
+    def test_waiting_backs_off(self):
+        cache.set("gcal:refresh:1", "somebody else")
+        delays = []
+
+        def sleep(delay):
+            delays.append(delay)
+            if len(delays) == 7:
+                # the other one is done
+                cache.delete("gcal:refresh:1")
+
+        fresh = Credentials(token="neu", expiry=datetime.utcnow() + timedelta(hours=1))
+        with mock.patch("display.gcal.time.sleep", sleep), \
+                mock.patch("display.gcal.load_credentials", return_value=fresh), \
+                mock.patch("display.gcal.refresh_credentials") as refresh:
+            self.assertIs(refresh_single_flight(1, Credentials(token="alt")), fresh)
+            refresh.assert_not_called()
+
+        self.assertEqual([round(delay, 1) for delay in delays], [0.1, 0.2, 0.4, 0.8, 1, 1, 1])
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+                   PUSH_INTERVAL=0.01, PUSH_MAX_AGE=60)
+class PushTest(SimpleTestCase):
+    def setUp(self):
+        self.current = {1: "eins", 2: "zwei"}
+        patcher = mock.patch.multiple(
+            push,
+            fingerprint=lambda cfg: self.current[cfg.pk],
+            fingerprints=lambda display_ids: {pk: self.current[pk] for pk in display_ids},
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_stream(self):
+        foyer = push.stream(SimpleNamespace(pk=1))
+        saal = push.stream(SimpleNamespace(pk=2))
+        self.assertEqual(await anext(foyer), "retry: 10\ndata: eins\n\n")
+        self.assertEqual(await anext(saal), "retry: 10\ndata: zwei\n\n")
+        poller = push._poller
+
+        # the poller wakes up the connections of that display, and only with what changed
+        self.current[1] = "neu"
+        self.assertEqual(await asyncio.wait_for(anext(foyer), 1), "data: neu\n\n")
+        self.assertEqual(push._known, {1: "neu", 2: "zwei"})
+
+        await foyer.aclose()
+        self.assertEqual(push._known, {2: "zwei"})
+        self.assertIs(push._poller, poller)
+
+        # the last one out turns off the light
+        await saal.aclose()
+        await asyncio.wait_for(poller, 1)
+        self.assertFalse(any(push._subscribers.values()))
+        self.assertEqual(push._known, {})
+        self.assertIsNone(push._poller)
+        self.assertEqual(push.connection_counts(), {})
+
+
+class RoomMatcherTest(SimpleTestCase):
+    def test_longest_name_wins(self):
+        # whatever the order of the table, "Saal" must not shadow "1/3 Saal"
+        for rooms in (ROOMS, ROOMS[::-1]):
+            with self.subTest(first=rooms[0][0]):
+                matcher = RoomMatcher(rooms)
+                self.assertEqual(matcher.find("1/3 Saal@KU")[1], "Saal (1/3)")
+                self.assertEqual(matcher.find("Yoga Kurs @ 1/3 saal")[1], "Saal (1/3)")
+                # both start at the same place
+                self.assertEqual(matcher.find("Saal 1/3@Geburtsvorbereitungskurs")[1], "Saal (1/3)")
+                self.assertEqual(matcher.find("KU@Saal")[1], "Saal")
+                self.assertIsNone(matcher.find("Jugendräume@FreakyFriday"))
+
+    def test_massage_kalendereintrag(self):
+        """
+        the examples from the docstring
+        """
+        matcher = RoomMatcher(ROOMS)
+        for eintrag, expected in [
+            ("@Sonnengruppenraum:Pekip", ("Pekip", "Sonnengruppenraum")),
+            ("@Mukiraum: CKU Pilates 18-19Uhr", ("CKU Pilates 18-19Uhr", "MuKi-Raum")),
+            ("1/3 Saal@KU", ("KU", "Saal (1/3)")),
+            ("@1/3 Saal: Franz. Kurs", ("Franz. Kurs", "Saal (1/3)")),
+            ("Saal 1/3@Geburtsvorbereitungskurs", ("Geburtsvorbereitungskurs", "Saal (1/3)")),
+            ("2/3 Saal @ Posaunenchor", ("Posaunenchor", "Saal (2/3)")),
+            ("KU@Saal", ("KU", "Saal")),
+            ("MuKiraum @ Tagesmütter", ("Tagesmütter", "MuKi-Raum")),
+            # no known room, what's left of the @ is the room
+            ("Jugendräume@FreakyFriday", ("FreakyFriday", "Jugendräume")),
+        ]:
+            with self.subTest(eintrag=eintrag):
+                self.assertEqual(massage_kalendereintrag(eintrag, matcher), expected)
+
+
+class TimelineTest(SimpleTestCase):
+    def at(self, hour, minute=0):
+        return datetime(2026, 10, 20, hour, minute, tzinfo=timezone.utc)
+
+    def test_inclusive_end(self):
+        timeline = Timeline([(self.at(9), self.at(10))], self.at(0), self.at(0) + timedelta(days=1))
+        self.assertFalse(timeline.is_on(self.at(8, 59)))
+        self.assertTrue(timeline.is_on(self.at(9)))
+        self.assertTrue(timeline.is_on(self.at(10)))
+        self.assertFalse(timeline.is_on(self.at(10, 1)))
+
+        self.assertEqual(timeline.next_transition(self.at(8)), self.at(9))
+        self.assertEqual(timeline.next_transition(self.at(9, 30)), self.at(10))
+        # nothing after that today
+        self.assertEqual(timeline.next_transition(self.at(11)), timeline.end)
+
+    def test_back_to_back(self):
+        """
+        one interval ends when the next starts: that is one, the display does not switch in between
+        """
+        timeline = Timeline([(self.at(11), self.at(12)), (self.at(9), self.at(10)), (self.at(10), self.at(11)),
+                             (self.at(14), self.at(15))],
+                            self.at(0), self.at(0) + timedelta(days=1))
+        self.assertEqual(timeline.starts, [self.at(9), self.at(14)])
+        self.assertEqual(timeline.ends, [self.at(12), self.at(15)])
+        self.assertTrue(timeline.is_on(self.at(10)))
+        self.assertEqual(timeline.next_transition(self.at(9, 30)), self.at(12))
+        self.assertEqual(timeline.next_transition(self.at(12, 30)), self.at(14))
+
+    def test_clipped_to_the_day(self):
+        timeline = Timeline([(self.at(0) - timedelta(hours=1), self.at(1))], self.at(0), self.at(0) + timedelta(days=1))
+        self.assertEqual(timeline.starts, [self.at(0)])
+
+
+def utc(*args):
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+@override_settings(TIME_ZONE="Europe/Berlin")
+class AvailabilityTest(SimpleTestCase):
+    def day(self, display_id, availability, year, month, day):
+        begin = utc(year, month, day) - timedelta(hours=2)
+        return availability.intervals(display_id, begin, begin + timedelta(days=1))
+
+    def test_cet_and_cest(self):
+        tuesdays = Availability([(None, 2, daytime(9), daytime(14))], [])
+        self.assertEqual(self.day(None, tuesdays, 2026, 1, 13), [(utc(2026, 1, 13, 8), utc(2026, 1, 13, 13))])
+        self.assertEqual(self.day(None, tuesdays, 2026, 7, 14), [(utc(2026, 7, 14, 7), utc(2026, 7, 14, 12))])
+        # not on wednesdays
+        self.assertEqual(self.day(None, tuesdays, 2026, 7, 15), [])
+
+    def test_dst_switches(self):
+        sundays = Availability([(None, 7, daytime(1), daytime(4)), (None, 7, daytime(9), daytime(14))], [])
+
+        # 2 o'clock CET is 3 o'clock CEST: the night is an hour short, the day starts in CEST
+        self.assertEqual(self.day(None, sundays, 2026, 3, 29), [
+            (utc(2026, 3, 29, 0), utc(2026, 3, 29, 2)),
+            (utc(2026, 3, 29, 7), utc(2026, 3, 29, 12)),
+        ])
+        # 3 o'clock CEST is 2 o'clock CET: the night is an hour long, the day is in CET
+        self.assertEqual(self.day(None, sundays, 2026, 10, 25), [
+            (utc(2026, 10, 24, 23), utc(2026, 10, 25, 3)),
+            (utc(2026, 10, 25, 8), utc(2026, 10, 25, 13)),
+        ])
+
+    def test_exceptions(self):
+        rules = [(None, 2, daytime(9), daytime(14)), (1, 2, daytime(18), daytime(20))]
+
+        for_everybody = Availability(rules, [(None, date(2026, 1, 13))])
+        self.assertEqual(self.day(1, for_everybody, 2026, 1, 13), [])
+        self.assertEqual(self.day(2, for_everybody, 2026, 1, 13), [])
+        # only that day
+        self.assertEqual(len(self.day(1, for_everybody, 2026, 1, 20)), 2)
+
+        for_one = Availability(rules, [(1, date(2026, 1, 13))])
+        self.assertEqual(self.day(1, for_one, 2026, 1, 13), [])
+        self.assertEqual(self.day(2, for_one, 2026, 1, 13), [(utc(2026, 1, 13, 8), utc(2026, 1, 13, 13))])
+
+    def test_display_and_global_rules(self):
+        availability = Availability([
+            (None, 2, daytime(9), daytime(12)),
+            (1, 2, daytime(11), daytime(15)),
+            (1, 2, daytime(18), daytime(20)),
+        ], [])
+
+        self.assertEqual(self.day(1, availability, 2026, 1, 13), [
+            (utc(2026, 1, 13, 8), utc(2026, 1, 13, 14)),
+            (utc(2026, 1, 13, 17), utc(2026, 1, 13, 19)),
+        ])
+        # the rules of display 1 are none of display 2's business
+        self.assertEqual(self.day(2, availability, 2026, 1, 13), [(utc(2026, 1, 13, 8), utc(2026, 1, 13, 11))])
+        self.assertEqual(self.day(None, availability, 2026, 1, 13), [(utc(2026, 1, 13, 8), utc(2026, 1, 13, 11))])
+
+    def test_office_hours(self):
+        """
+        the rules 0014 adds are the hours should_be_always_on() had hard coded, in UTC on a CET day
+        """
+        def should_be_always_on(n):
+            if n.isoweekday() in (2, 4):
+                return 8 <= n.hour <= 12
+            if n.isoweekday() == 3:
+                return 13 <= n.hour <= 17
+            return False
+
+        office_hours = importlib.import_module("display.migrations.0014_availability").OFFICE_HOURS
+        availability = Availability([(None, weekday, start, end) for weekday, start, end in office_hours], [])
+
+        # a week in january
+        for day in range(12, 19):
+            intervals = self.day(None, availability, 2026, 1, day)
+            for minute in range(0, 24 * 60, 15):
+                n = utc(2026, 1, day) + timedelta(minutes=minute)
+                with self.subTest(n=n):
+                    self.assertEqual(any(start <= n < end for start, end in intervals), should_be_always_on(n))
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class FetchAllTest(SimpleTestCase):
+    """
+    displays sharing a calendar must not sync it all at once
+    """
+
+    def setUp(self):
+        cache.clear()
+
+    def test_one_refresh_at_a_time(self):
+        calls = []
+
+        def refresh(calendar):
+            calls.append(calendar.pk)
+            time.sleep(0.2)
+            return NO_EVENTS
+
+        item = SimpleNamespace(typ="next_events", calendar=SimpleNamespace(pk=1))
+        results = []
+        with mock.patch("display.sources.refresh_calendar", refresh):
+            threads = [threading.Thread(target=lambda: results.append(fetch_all([item]))) for i in range(6)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, [{calendar_key(item.calendar): NO_EVENTS}] * 6)
+
+    def test_slow_or_failing_refresh(self):
+        key = calendar_key(SimpleNamespace(pk=1))
+        item = SimpleNamespace(typ="next_events", calendar=SimpleNamespace(pk=1))
+
+        def slow(calendar):
+            time.sleep(0.3)
+            return "neu"
+
+        def failing(calendar):
+            raise ConnectionError("google ist weg")
+
+        for refresh in (slow, failing):
+            with self.subTest(refresh=refresh.__name__):
+                # stale, but there is something
+                cache.set(key, dict(new_state(), value="von gestern"))
+                with mock.patch("display.sources.refresh_calendar", refresh), self.assertLogs("display.sources"):
+                    self.assertEqual(fetch_all([item], timeout=0.1), {key: "von gestern"})
+                # let the slow one finish before the next round
+                time.sleep(0.3)
+
+    def test_refreshing_elsewhere(self):
+        key = calendar_key(SimpleNamespace(pk=1))
+        cache.set(key, dict(new_state(), value="von gestern"))
+        # another process has the lock
+        cache.set(f"{key}:refreshing", 1)
+
+        item = SimpleNamespace(typ="next_events", calendar=SimpleNamespace(pk=1))
+        with mock.patch("display.sources.refresh_calendar") as refresh:
+            self.assertEqual(fetch_all([item]), {key: "von gestern"})
+            refresh.assert_not_called()
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class SingleFlightTest(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_building_elsewhere(self):
+        cache.set("page:building", "somebody else")
+        build = mock.Mock(return_value=("neu", 60))
+
+        cache.set("page:last", "alt")
+        self.assertEqual(single_flight("page", "page:last", build), ("alt", False))
+
+        cache.delete("page:last")
+        with mock.patch("display.pagecache.BUILD_WAIT", 0.5):
+            self.assertEqual(single_flight("page", "page:last", build), (None, False))
+        build.assert_not_called()
+        self.assertEqual(cache.get("page:building"), "somebody else")
+
+    def test_lock_taken_over(self):
+        def build():
+            # took longer than BUILD_LOCK_TIMEOUT, somebody else builds it now
+            cache.set("page:building", "somebody else")
+            return "neu", 60
+
+        self.assertEqual(single_flight("page", "page:last", build), ("neu", True))
+        self.assertEqual(cache.get("page:building"), "somebody else")
+        self.assertEqual(cache.get("page:last"), "neu")
+
+
+def event(event_id, summary="Chorprobe", status="confirmed"):
+    start = start_of_day() + timedelta(hours=18)
+    return dict(id=event_id, summary=summary, status=status, start=dict(dateTime=start.isoformat()),
+                end=dict(dateTime=(start + timedelta(hours=2)).isoformat()))
+
+
+class FakeRequest:
+    def __init__(self, respond):
+        self.respond = respond
+
+    def execute(self):
+        return self.respond()
+
+
+class FakeBatch:
+    def __init__(self, callback, executed):
+        self.callback = callback
+        self.requests = []
+        self.executed = executed
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        if len(self.requests) > 50:
+            raise HttpError(Response({"status": 400}), b"Too many requests in a batch")
+        self.executed.append(len(self.requests))
+        for request_id, request in self.requests:
+            try:
+                self.callback(request_id, request.execute(), None)
+            except HttpError as e:
+                self.callback(request_id, None, e)
+
+
+class FakeService:
+    """
+    google calendar, as far as the sync needs it. full syncs get full, a sync token
+    gets changes, or a 410 if expired. everything comes in pages of two.
+    """
+
+    def __init__(self, full=(), changes=(), expired=False):
+        self.full = list(full)
+        self.changes = list(changes)
+        self.expired = expired
+        self.calls = []
+        self.batches = []  # the number of calls in each
+
+    def events(self):
+        return self
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(callback, self.batches)
+
+    def list(self, **params):
+        self.calls.append(params)
+        return FakeRequest(lambda: self.respond(params))
+
+    def respond(self, params):
+        if "syncToken" in params:
+            if self.expired:
+                raise HttpError(Response({"status": 410}), b"Sync token is no longer valid")
+            items, token = self.changes, "changes-token"
+        else:
+            items, token = self.full, "full-token"
+
+        page = int(params.get("pageToken") or 0)
+        result = dict(items=items[page:page + 2])
+        if page + 2 < len(items):
+            result["nextPageToken"] = str(page + 2)
+        else:
+            result["nextSyncToken"] = token
+        return result
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class CalendarSyncTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user("gemeindebuero")
+        self.new_calendar()
+
+    def new_calendar(self):
+        self.calendar = CalendarConnection.objects.create(user=self.user, calendar_id=f"c{CalendarConnection.objects.count()}")
+
+    def sync(self, service, batch=False):
+        with mock.patch("display.models.get_credentials", return_value=object()), \
+                mock.patch("display.models.calendar_service", return_value=service):
+            if batch:
+                self.assertEqual(sync_calendars([self.calendar]), {})
+            else:
+                self.calendar.sync_events()
+        self.calendar.refresh_from_db()
+
+    def stored(self):
+        return sorted(self.calendar.events.values_list("event_id", "data__summary"))
+
+    def test_full_sync(self):
+        self.sync(FakeService(full=[event("a"), event("b"), event("c")]))
+        self.assertEqual(self.stored(), [("a", "Chorprobe"), ("b", "Chorprobe"), ("c", "Chorprobe")])
+        self.assertEqual(self.calendar.sync_token, "full-token")
+        self.assertIsNotNone(self.calendar.last_full_sync)
+
+    def test_changes(self):
+        for batch in (False, True):
+            with self.subTest(batch=batch):
+                self.new_calendar()
+                self.sync(FakeService(full=[event("a"), event("b")]))
+                service = FakeService(changes=[event("a", "Posaunenchor"), event("b", status="cancelled"), event("c")])
+                self.sync(service, batch)
+
+                self.assertIn("syncToken", service.calls[0])
+                self.assertEqual(self.stored(), [("a", "Posaunenchor"), ("c", "Chorprobe")])
+                self.assertEqual(self.calendar.sync_token, "changes-token")
+
+    def test_expired_sync_token(self):
+        """
+        google forgot the sync token (410): everything again
+        """
+        for batch in (False, True):
+            with self.subTest(batch=batch):
+                self.new_calendar()
+                self.sync(FakeService(full=[event("a"), event("b")]))
+                service = FakeService(full=[event("b"), event("c")], expired=True)
+                self.sync(service, batch)
+
+                self.assertEqual([("syncToken" in params) for params in service.calls if "pageToken" not in params],
+                                 [True, False])
+                self.assertEqual(self.stored(), [("b", "Chorprobe"), ("c", "Chorprobe")])
+                self.assertEqual(self.calendar.sync_token, "full-token")
+
+    def test_daily_full_sync(self):
+        """
+        the first sync of a day is a full one, events that left the window are gone after it
+        """
+        for batch in (False, True):
+            with self.subTest(batch=batch):
+                self.new_calendar()
+                self.sync(FakeService(full=[event("a"), event("b")]))
+                CalendarConnection.objects.filter(pk=self.calendar.pk).update(
+                    last_full_sync=start_of_day() - timedelta(minutes=1))
+                self.calendar.refresh_from_db()
+
+                service = FakeService(full=[event("b")], changes=[event("x")])
+                self.sync(service, batch)
+
+                self.assertNotIn("syncToken", service.calls[0])
+                self.assertEqual(self.stored(), [("b", "Chorprobe")])
+                self.assertGreaterEqual(self.calendar.last_full_sync, start_of_day())
+
+                # the next one of the day is incremental again
+                service = FakeService(changes=[event("x")])
+                self.sync(service, batch)
+                self.assertIn("syncToken", service.calls[0])
+                self.assertEqual(self.stored(), [("b", "Chorprobe"), ("x", "Chorprobe")])
+
+    def test_many_calendars(self):
+        """
+        google takes 50 calls per batch at most
+        """
+        calendars = [self.calendar] + [
+            CalendarConnection.objects.create(user=self.user, calendar_id=f"raum{i}") for i in range(119)
+        ]
+        service = FakeService(full=[event("a")])
+        with mock.patch("display.models.get_credentials", return_value=object()), \
+                mock.patch("display.models.calendar_service", return_value=service):
+            self.assertEqual(sync_calendars(calendars), {})
+
+        self.assertEqual(service.batches, [50, 50, 20])
+        self.assertEqual(CalendarConnection.objects.filter(sync_token="full-token").count(), 120)
+
+    def test_no_google_token(self):
+        """
+        a calendar nobody can fetch is a failure, not a success
+        """
+        for refresh in (refresh_calendar, lambda calendar: refresh_calendars([calendar])):
+            with self.subTest(refresh=refresh):
+                cache.clear()
+                with self.assertLogs("display.sources", "ERROR"):
+                    refresh(self.calendar)
+                state = cache.get(calendar_key(self.calendar))
+                self.assertIsNone(state["fetched"])
+                self.assertEqual(state["failures"], 1)
+                self.assertIn("NoCredentials", state["error"])
+                self.assertIsNotNone(state["retry"])
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage",
+    MEDIA_ROOT=tempfile.mkdtemp(),
+)
+class PageCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.displays = []
+        for name in ("eingang", "saal"):
+            banner = ImageSlide(title=f"Banner {name}")
+            banner.image.save(f"{name}.png", ContentFile(png()))
+            cfg = DisplayConfiguration.objects.create(name=name)
+            cfg.items.create(typ="banner", banner=banner)
+            self.displays.append(cfg)
+
+    def versions(self):
+        return [cache.get(page_version_key(cfg.pk)) for cfg in self.displays]
+
+    def test_changes_forget_only_their_displays(self):
+        eingang, saal = self.displays
+        for change, expected in (
+            (lambda: eingang.items.get().banner.save(), ["eingang"]),
+            (lambda: saal.items.get().save(), ["saal"]),
+            (lambda: eingang.items.create(typ="gottesdienste"), ["eingang"]),
+            (lambda: saal.items.get().banner.delete(), ["saal"]),
+        ):
+            before = self.versions()
+            change()
+            after = self.versions()
+            self.assertEqual([cfg.name for cfg, old, new in zip(self.displays, before, after) if old != new], expected)
+
+    def test_missing_source(self):
+        """
+        a page without a source that is not there yet is not kept for long
+        """
+        calendar = CalendarConnection.objects.create(user=User.objects.create_user("gemeindebuero"), calendar_id="c1")
+        cfg = self.displays[0]
+        cfg.items.create(typ="next_events", calendar=calendar)
+        items = list(cfg.items.select_related("banner", "calendar"))
+
+        with mock.patch("display.views.fetch_all", return_value={}):
+            context = presentation_context(cfg, items, False, False)
+        self.assertEqual(context["missing_sources"], [calendar_key(calendar)])
+        self.assertLessEqual(presentation_timeout(cfg, context), settings.PREFETCH_TIMEOUT)
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage",
+)
+class StatusTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.cfg = DisplayConfiguration.objects.create(name="eingang")
+
+    def now_slide_in(self, delta):
+        """
+        a "Jetzt" slide starting in delta, the display goes on an hour before
+        """
+        banner = ImageSlide.objects.create(title="Jetzt", image="jetzt.png")
+        item = self.cfg.items.create(typ="banner", banner=banner, now_start=now() + delta, how_long=timedelta(hours=1))
+        # the end of the timeline, if that's earlier
+        return min(item.now_start - timedelta(hours=1), start_of_day() + timedelta(days=1))
+
+    def test_next_transition(self):
+        transition = self.now_slide_in(timedelta(hours=3))
+        response = self.client.get("/status/eingang")
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(datetime.fromisoformat(response.headers["X-Next-Transition"]), transition)
+
+    def test_max_age(self):
+        """
+        until the next transition, but no longer than until the next calendar sync
+        """
+        for delta in (timedelta(hours=3), timedelta(hours=1, seconds=120)):
+            with self.subTest(delta=delta):
+                cache.clear()
+                self.cfg.items.all().delete()
+                transition = self.now_slide_in(delta)
+                response = self.client.get("/status/eingang")
+
+                max_age = min((transition - now()).total_seconds(), settings.CALENDAR_SYNC_INTERVAL)
+                self.assertAlmostEqual(get_max_age(response), max_age, delta=2)
+                expires = parsedate_to_datetime(response.headers["Expires"])
+                self.assertAlmostEqual(expires.timestamp(), now().timestamp() + max_age, delta=2)
+
+    def test_preview_etag(self):
+        response = self.client.get("/status/eingang?vorschau=1")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("no-cache", response.headers["Cache-Control"])
+
+        again = self.client.get("/status/eingang?vorschau=1", HTTP_IF_NONE_MATCH=response.headers["ETag"])
+        self.assertEqual(again.status_code, 304)
+
+        # a new "Jetzt" slide changes the table
+        self.now_slide_in(timedelta(hours=3))
+        changed = self.client.get("/status/eingang?vorschau=1", HTTP_IF_NONE_MATCH=response.headers["ETag"])
+        self.assertEqual(changed.status_code, 200)
+
+    def test_timeline_cache(self):
+        calendar = CalendarConnection.objects.create(user=User.objects.create_user("gemeindebuero"), calendar_id="c1")
+        self.cfg.items.create(typ="next_events", calendar=calendar)
+
+        with mock.patch("display.views.cache.set", wraps=cache.set) as cache_set:
+            # a calendar that could not be fetched is not cached for the whole day
+            with mock.patch("display.views.fetch_all", return_value={}):
+                self.client.get("/status/eingang")
+            self.assertFalse([call for call in cache_set.call_args_list if call.args[0].startswith("timeline:")])
+
+            # the others only until the calendars are synced again
+            with mock.patch("display.views.fetch_all", return_value={calendar_key(calendar): NO_EVENTS}):
+                self.client.get("/status/eingang")
+            (key, timeline, timeout), = [call.args for call in cache_set.call_args_list if call.args[0].startswith("timeline:")]
+            self.assertLessEqual(timeout, settings.CALENDAR_SYNC_INTERVAL)
+
+
+def png():
+    image = io.BytesIO()
+    Image.new("RGB", (4, 4)).save(image, "PNG")
+    return image.getvalue()
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage",
+    MEDIA_ROOT=tempfile.mkdtemp(),
+)
+class QueryCountTest(TestCase):
+    """
+    the number of queries must not grow with the number of items
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.staff = User.objects.create_user("kiosk", is_staff=True)
+
+    def display(self, name, banners=0, calendars=0, gottesdienste=0):
+        """
+        a display with that many items of each sort, their sources fresh in the cache
+        """
+        cfg = DisplayConfiguration.objects.create(name=name)
+        for i in range(banners):
+            banner = ImageSlide(title=f"Banner {i}")
+            banner.image.save(f"banner{i}.png", ContentFile(png()))
+            cfg.items.create(typ="banner", banner=banner, position=i)
+
+        for i in range(calendars):
+            calendar = CalendarConnection.objects.create(user=self.staff, calendar_id=f"{name}-{i}", last_sync=now())
+            start = start_of_day() + timedelta(minutes=1)
+            calendar.events.create(event_id="e1", start=start, end=start + timedelta(hours=1), data=dict(
+                id="e1", summary="Chorprobe", start=dict(dateTime=start.isoformat()),
+                end=dict(dateTime=(start + timedelta(hours=1)).isoformat()),
+            ))
+            refresh_calendar(calendar)
+            cfg.items.create(typ="next_events", calendar=calendar, position=i)
+
+        if gottesdienste:
+            save_state(GOTTESDIENSTE_KEY, dict(new_state(), value=[], checked=now(), max_age=3600))
+        for i in range(gottesdienste):
+            cfg.items.create(typ="gottesdienste", position=i)
+
+        return cfg
+
+    def displays(self):
+        """
+        the names of displays with one and with five items of every sort
+        """
+        for sort in ("banners", "calendars", "gottesdienste"):
+            for n in (1, 5):
+                name = f"{sort}{n}"
+                self.display(name, **{sort: n})
+                yield name
+
+    def test_show_presentation(self):
+        for name in self.displays():
+            with self.subTest(name=name):
+                # one of them is for the refresh slots, they are cached until a display changes
+                with self.assertNumQueries(5):
+                    self.assertEqual(self.client.get(f"/display/{name}").status_code, 200)
+                # unchanged: 304 without rendering
+                etag = self.client.get(f"/display/{name}").headers["ETag"]
+                with self.assertNumQueries(2):
+                    self.assertEqual(self.client.get(f"/display/{name}", HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    @override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.db.DatabaseCache",
+                                           "LOCATION": "test_cache"}})
+    def test_not_modified_with_database_cache(self):
+        """
+        like in production, where every cache access is a query as well
+        """
+        call_command("createcachetable", verbosity=0)
+        self.display("test", 1)
+        etag = self.client.get("/display/test").headers["ETag"]
+        # the display, its items and one get_many of the versions
+        with self.assertNumQueries(3):
+            self.assertEqual(self.client.get("/display/test", HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_etag_at_switch(self):
+        """
+        a banner ends while its page is still cached: the old page keeps its old ETag
+        """
+        self.display("test", 1)
+        before = self.client.get("/display/test")
+        self.assertContains(before, "banner0")
+
+        # nobody saves anything, the banner just ends
+        ImageSlide.objects.update(show_end=now() - timedelta(seconds=1))
+        cached = self.client.get("/display/test")
+        self.assertContains(cached, "banner0")
+        self.assertEqual(cached.headers["ETag"], before.headers["ETag"])
+
+        response = self.client.get("/display/test", HTTP_IF_NONE_MATCH=before.headers["ETag"])
+        self.assertEqual(response.status_code, 200)
+
+    def test_stale_while_building(self):
+        self.display("test", 1)
+        self.assertEqual(self.client.get("/display/test/data.json").status_code, 200)
+
+        # the page is outdated and somebody else is building the new one
+        DisplayConfiguration.objects.get(name="test").save()
+        with mock.patch("display.pagecache.cache.add", return_value=False), \
+                mock.patch("display.views.presentation_data") as build:
+            self.assertEqual(self.client.get("/display/test/data.json").status_code, 200)
+            build.assert_not_called()
+
+        response = self.client.get("/display/test")
+        self.assertIn("ETag", response.headers)
+        self.assertIn("Refresh", response.headers)
+
+    def test_data_json(self):
+        for name in self.displays():
+            with self.subTest(name=name):
+                with self.assertNumQueries(3):
+                    self.assertEqual(self.client.get(f"/display/{name}/data.json").status_code, 200)
+
+    def test_display_status(self):
+        # the availability rules are read once for all displays
+        availability()
+        for name in self.displays():
+            with self.subTest(name=name):
+                with self.assertNumQueries(2):
+                    self.client.get(f"/status/{name}")
+
+    def test_status_does_not_scrape(self):
+        cfg = self.display("test")
+        cfg.items.create(typ="gottesdienste")
+        with mock.patch("display.sources.refresh_gottesdienste") as refresh:
+            # nothing from calendars: off
+            self.assertEqual(self.client.get("/status/test").status_code, 204)
+            refresh.assert_not_called()
+
+    def test_banner_upload(self):
+        for displays in (1, 5):
+            with self.subTest(displays=displays):
+                DisplayConfiguration.objects.all().delete()
+                for i in range(displays):
+                    self.display(f"test{i}", 1)
+
+                self.client.force_login(self.staff)
+                upload = SimpleUploadedFile("neu.png", png(), content_type="image/png")
+                with self.assertNumQueries(10):
+                    self.client.post("/wartungsklappe/", {"file": upload})
+                self.assertEqual(DisplayConfigurationItem.objects.filter(banner__title__startswith="Neuer Banner").count(), displays)
@@ -0,0 +1,83 @@
+"""
+Questions about time: what is going on at t, what starts next, what happens today.
+"""
+import itertools
+from bisect import bisect_left, bisect_right
+from datetime import timedelta
+
+
+class EventIndex:
+    """
+    events sorted by start, built once per fetch. every question is answered by bisecting.
+    """
+
+    def __init__(self, events):
+        self.events = sorted(events, key=lambda event: event.start)
+        self.starts = [event.start for event in self.events]
+        # latest end of all events up to i, for the "what is going on" question
+        self.max_ends = list(itertools.accumulate((event.end for event in self.events), max))
+
+    def __len__(self):
+        return len(self.events)
+
+    def active_at(self, t, lead=timedelta(0), lag=timedelta(0)):
+        """
+        is any event going on at t? an event counts from lead before its start until lag after its end.
+        """
+        i = bisect_right(self.starts, t + lead)
+        return i > 0 and self.max_ends[i - 1] + lag >= t
+
+    def starting_between(self, begin, end):
+        """
+        events starting in [begin, end], in order.
+        """
+        return self.events[bisect_left(self.starts, begin):bisect_right(self.starts, end)]
+
+    def last_starting_between(self, begin, end, include_end=True):
+        """
+        the latest event starting in [begin, end] (or [begin, end) without include_end), None if there is none.
+        """
+        i = bisect_left(self.starts, begin)
+        j = (bisect_right if include_end else bisect_left)(self.starts, end)
+        return self.events[j - 1] if j > i else None
+
+
+class Timeline:
+    """
+    when a display should be ON, as sorted, merged intervals within [begin, end).
+    """
+
+    def __init__(self, intervals, begin, end):
+        self.begin = begin
+        self.end = end
+        self.starts = []
+        self.ends = []
+
+        for start, stop in sorted(intervals):
+            start, stop = max(start, begin), min(stop, end)
+            if start > stop:
+                continue
+
+            if self.ends and start <= self.ends[-1]:
+                self.ends[-1] = max(self.ends[-1], stop)
+            else:
+                self.starts.append(start)
+                self.ends.append(stop)
+
+    def is_on(self, t):
+        i = bisect_right(self.starts, t) - 1
+        return i >= 0 and t <= self.ends[i]
+
+    def next_transition(self, t):
+        """
+        when the answer of is_on() changes after t. the end of the timeline, if it does not change before.
+        """
+        i = bisect_right(self.starts, t) - 1
+        if i >= 0 and t <= self.ends[i]:
+            return self.ends[i]
+
+        if i + 1 < len(self.starts):
+            return self.starts[i + 1]
+
+        return self.end
+
@@ -1,409 +1,240 @@
-import collections
-import itertools
-import locale
+import hashlib
+import json
 import logging
-import re
-from datetime import timedelta, datetime
-import time
-import requests
-from allauth.socialaccount.models import SocialToken
+from datetime import timedelta
+from asgiref.sync import sync_to_async
 from django.contrib import messages
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.core.cache import cache
-from django.core.mail import mail_admins
+from django.core.handlers.asgi import ASGIRequest
 from django.forms import ModelForm, SplitDateTimeWidget, SplitDateTimeField, DateTimeInput, DateTimeField, \
     ModelMultipleChoiceField, CheckboxSelectMultiple
-from django.http import HttpResponse
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, redirect, get_object_or_404
-from django.utils import timezone
-from django.utils.timezone import now, make_aware, is_aware
+from django.template.loader import render_to_string
+from django.utils.timezone import now
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_response_headers
+from django.utils.http import quote_etag
 
 from django.conf import settings
-from django.views.decorators.cache import cache_page
 from django.views.decorators.clickjacking import xframe_options_sameorigin
 from google.auth.exceptions import RefreshError
 
-from display.models import ImageSlide, CalendarConnection, DisplayConfiguration
+from display import push
+from display.availability import always_on_intervals, availability_version
+from display.gcal import calendar_service, get_credentials
+from display.http import breakers
+from display.models import ImageSlide, CalendarConnection, DisplayConfiguration, DisplayConfigurationItem, \
+    start_of_day
+from display.pagecache import forget_pages, jittered, last_good_key, page_etag, page_key, page_timeout, \
+    refresh_slot, single_flight
+from display.sources import GOTTESDIENSTE_KEY, NO_EVENTS, calendar_key, fetch_all, refresh_calendars, source_keys, \
+    source_states
+from display.timeline import Timeline
 
 from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
-Event = collections.namedtuple("Event", "start end summary allday jugend room")
-
 # Create your views here.
 
 logger = logging.getLogger(__name__)
 
+# how long browsers may keep a display page, the server side copy is kept up to date
+PAGE_CLIENT_MAX_AGE = 60
+# slideshows update themselves, but reload after this many seconds anyway
+PAGE_SAFETY_REFRESH = 6 * 60 * 60
+# a page that is still being built somewhere else is asked for again after this many seconds
+BUILD_RETRY_AFTER = 5
+
 def index(request):
     return render(request, "display/index.html", context=dict(displays=DisplayConfiguration.objects.all()))
 
 
-def start_of_day():
-    utcnow = datetime.utcnow()
-    return make_aware(datetime(utcnow.year, utcnow.month, utcnow.day), timezone.utc)
-
-def scrape_gottesdienste():
-    locale.setlocale(locale.LC_ALL, 'de_DE.UTF-8')
-
-    gottesdienste = []
-
-    r = requests.get('https://www.kirche-froemern.de/gruppen-angebote/gottesdienste')
-
-    from bs4 import BeautifulSoup
-    soup = BeautifulSoup(r.text)
-
-    for t in soup.find_all("table", class_="contenttable"):
-
-        first_row = t.find("tr")
-        if len(first_row.find_all("td")) == 4: # multi table
-            orte = []
-            for row in t.find_all("tr"):
-                if len(row.find_all("td")) < 4:
-                    continue
-
-                if not orte:
-                    orte.append("")
-                    for col in row.find_all("td"):
-                        t = col.get_text().strip()
-                        if t:
-                            orte.append(t.strip())
-
-                    continue
-
-                day = None
-                untertitel = ""
-                for ort, col in zip(orte, row.find_all("td")):
-
-                    try:
-                        if not ort:
-                            p_elements = col.find_all("p")
-                            datum = p_elements[0].get_text().strip()
-                            untertitel = " ".join(e.get_text().strip() for e in p_elements[1:])
-                            day = time.strptime(datum, "%d. %B")
-
-                        else:
-                            p_elements = col.find_all("p")
-                            uhrzeit = p_elements[0].get_text().strip()
-                            titel = " ".join(e.get_text().strip() for e in p_elements[1:])
-                            uhrzeit = time.strptime(uhrzeit, "%H:%M")
-                            date = datetime.utcnow().replace(day=day.tm_mday, month=day.tm_mon, hour=uhrzeit.tm_hour, minute=uhrzeit.tm_min, second=0)
-                            make_aware(date)
-                            gottesdienste.append(Event(date, date, titel, False, False, f"{ort} ({untertitel})"))
-
-
-
-                    except ValueError:
-                        continue # skip if broken
-
-
-        else:
-
-            for row1, row2 in itertools.pairwise(t.find_all("tr")):
-                date, thetime = row1.find_all("td")
-                sonntag, beschreibung = row2.find_all("td")
-
-                monate = dict(Jan=1, Feb=2, Mar=3, Apr=4, Mai=5, Jun=6, Jul=7, Aug=8, Sep=9, Okt=10, Nov=11, Dez=12)
-                month = None
-                for monat, imonat in monate.items():
-                    if monat in date.get_text():
-                        month = imonat
-
-                if month is None:
-                    continue
-
-                day = int(re.sub(r"[^0-9]", "", date.get_text()))
-
-                if not ":" in thetime.get_text():
-                    continue
-
-                hour,minute = thetime.get_text().split(":")
-
-                hour = int(hour)
-                minute = int(minute)
-
-                start = datetime.utcnow().replace(month=month, day=day, hour=hour, minute=minute, second=0,microsecond=0)
-                start = make_aware(start)
-
-                if start < start_of_day():
-                    continue
-
-
-                gottesdienste.append(Event(start, start, beschreibung.get_text(), False, False, sonntag.get_text()))
-
-
-    return gottesdienste[:8]
-
-
-
-
-
-def massage_kalendereintrag(eintrag):
-    """
-    try and decipher the kalendereintrag. return "Summary", "Room"
-
-    Should be:
-
-    Room @ Event
-
-    But often it's not.
-
-    i.e.
-
-    @Sonnengruppenraum:Pekip -> "Pekip", "Sonnengruppenraum"
-
-    @Mukiraum: CKU Pilates 18-19Uhr -> "CKU Pilates 18-19Uhr", "Mukiraum"
-
-    1/3 Saal@KU
-    DienstgespÃ¤ch HAMA @ GemeindebÃ¼ro
-    2/3 Saal@Frauenhilfe
-    @1/3 Saal: Franz. Kurs
-    @Mukiraum: CKU Pilates 18-19Uhr
-    3/3 Saal @ WirbelsÃ¤ulengymnastik
-    KU@Saal
-    1/3 Saal@Bastelkreis
-    2/3 Saal@Seniorenkreis
-    JugendrÃ¤ume@FreakyFriday
-    MuKiraum @ TagesmÃ¼tter
-    1/3 Saal @ Dienstagsfrauen
-    1/3 Saal@ Jugend MAGK
-    9-12.15 h PEKiP / CKU SonnengrupRraum
-    3/3 Saal @ Gymnastik
-    2/3 Saal @ Posaunenchor
-    MuKiRaum @ PEKIP/ CKU
-    Yoga Kurs @ 1/3 Saal
-    MuKiRaum@RÃ¼ckbildungsgymnastik
-    Saal 1/3@Geburtsvorbereitungskurs
-    @Sonnengruppenraum:Pekip
-    1/3Saal @ Cafe Knirps
-    """
-    eintrag = eintrag.strip()
-
-    if len(eintrag) < 5:
-        # generate complaint?
-        return eintrag
-
-    known_rooms = {"1/3 Saal": "⅓ Saal",
-                   "1/3Saal": "⅓ Saal",
-                  "2/3 Saal": "⅔ Saal",
-                  "3/3 Saal": "Ganzer Saal",
-                  "MuKiRaum": "MuKi-Raum",
-                  "Sonnengruppenraum": "Sonnengruppenraum",
-                  "SonnengrupRraum": "Sonnengruppenraum",
-                  "Jugendräume": "Jugendräume",
-                  "Saal": "Ganzer Saal",
-                  "Gemeindebüro" : "Gemeindebüro",
-                  }
-
-    room = ""
-    summary = eintrag
-
-    for name, alias in known_rooms.items():
-        if name.lower() in eintrag.lower():
-            # we found a known room.
-            room = alias
-            s = re.sub('(?i)' + re.escape(name.lower()), "", eintrag)
-            s = s.replace("@", "").strip()
-            if s[0] == ":":
-                s = s[1:]
-
-            if s[-1] == ":":
-                s = s[:-1]
-
-            summary = s
-            break
-
-    if not room and "@" in eintrag:
-        if eintrag[0] == "@" and ":" in eintrag:
-            lhs, rhs = eintrag[1:].split(":")
-        else:
-            lhs, rhs = eintrag.split("@")
-
-        room = lhs.strip()
-        summary = rhs.strip()
-
-
-    if summary:
-        return summary, room
-    else: # FIXME: add complaints department?
-        return eintrag, ""
-
-
-
 import pprint
 
 @staff_member_required
 def kalender_dump(request):
     data = ""
 
-    for cal in CalendarConnection.objects.all():
-        try:
-            token = SocialToken.objects.get(
-                account__user=cal.user, account__provider="google"
-            )
-        except SocialToken.DoesNotExist:
-            continue
-        try:
-            credentials = Credentials(
-                token=token.token,
-                refresh_token=token.token_secret,
-                token_uri="https://oauth2.googleapis.com/token",
-                client_id=settings.SOCIALACCOUNT_PROVIDERS["google"]["APP"][
-                    "client_id"
-                ],  # replace with yours
-                client_secret=settings.SOCIALACCOUNT_PROVIDERS["google"]["APP"][
-                    "secret"
-                ],
-            )
-
-            if not credentials or not credentials.valid or credentials.expired and token.token_secret:
-                credentials.refresh()
-                token.token = credentials.token
-                if credentials.refresh_token and credentials.refresh_token != token.token_secret:
-                    token.token_secret = credentials.refresh_token
-
-                token.save()
-
-            googlenow = start_of_day().isoformat() + "Z"  # 'Z' indicates UTC time
-
-            service = build("calendar", "v3", credentials=credentials)
-            events_result = (
-                service.events()
-                .list(
-                    calendarId="primary" and cal.calendar_id,
-                    timeMin=googlenow,
-                    maxResults=50,
-                    singleEvents=True,
-                    orderBy="startTime",
-                )
-                .execute()
-            )
-        except RefreshError:
-            logger.exception("Refresh woes in slideshow")
-            continue
+    calendars = CalendarConnection.objects.all()
+    refresh_calendars(calendars)  # syncs the due ones in one batch per google account
 
-        data += "\n\n" + pprint.pformat(events_result.get("items", []))
+    for cal in calendars:
+        data += "\n\n" + pprint.pformat(cal.load_events(howmany=50))
 
     return HttpResponse(data, content_type="text/plain")
 
 
-def load_events(calcfg):
+def iter_items(cfg):
     n = now()
-    start_of_day = n.replace(hour=0, minute=0, second=0)
-    end_of_day = n.replace(hour=23, minute=59, second=59)
-
-    today_events = []  # was geht heute so? (Auch Vergangenes)
-    next_event = None  # nächstes Ereignis das in der nächsten Stunde startet.
-    current_event = (
-        None  # letztes Ereignis, wenn es  in der letzten Stunde startete.
-    )
-    next_events = []  # die nächsten fünf Events
-    preview_events = []  # speziell markierte vorschau events
-    special_event = None
-    events = calcfg.load_events()
+    return cfg.items.filter(show_start__lt=n, show_end__gt=n).select_related("banner", "calendar").order_by("position")
 
-    for event in events:
-        start = event["start"].get("dateTime", event["start"].get("date"))
-        end = event["end"].get("dateTime", event["end"].get("date"))
+def find_display(display):
+    try:
+        return DisplayConfiguration.objects.get(name=display)
+    except DisplayConfiguration.DoesNotExist:
+        return DisplayConfiguration.objects.order_by("name").first()
 
-        allday = not "dateTime" in event["start"]
-        summary = event.get("summary", "")
 
-        is_preview_event = "⏰" in summary
-        is_special_event = "🎉" in summary
-        is_jugend = "🚸" in summary
-        is_hidden = "👻" in summary
+@xframe_options_sameorigin
+def show_presentation(request, display="", portrait=""):
+    show_controls = not not request.GET.get("kontrolle") # should be UserAgent or something like that.
+    portrait = not not portrait
+    cfg = find_display(display)
 
-        is_preview_event |= "[pre]" in summary
-        is_special_event |= "[codo]" in summary
-        is_jugend |= "[evj]" in summary
-        is_hidden |= "[intern]" in summary
+    etag = quote_etag(page_etag(cfg, portrait, show_controls))
+    response = get_conditional_response(request, etag=etag)
+    if response is not None:
+        # nothing else to do for a 304, the kiosk keeps what it has
+        return response
 
-        summary = summary.replace("⏰", "").replace("🎉", "").replace("🚸", "")
-        summary = summary.replace("[pre]", "").replace("[codo]", "").replace("[evj]", "").replace("[intern]", "")
+    items = list(iter_items(cfg))
 
-        if is_hidden:
-            continue
+    def build():
+        response, timeout = render_presentation(request, cfg, items, portrait, show_controls)
+        # the ETag is cached with the page: a page built before an item switched keeps the ETag
+        # from before, it is computed before the items are fetched.
+        response.headers["ETag"] = etag
+        return response, timeout
 
+    response, _ = single_flight(
+        page_key(cfg, items, portrait, show_controls),
+        last_good_key(cfg, portrait, show_controls),
+        build,
+    )
+    if response is None:
+        return still_building()
 
-        try:
-            summary, room = massage_kalendereintrag(summary)
-        except Exception as e:
-            mail_admins("massage_kalendereintrag ist unglücklich", str(e))
-            logger.exception("massage_kalendereintrag ist unglücklich")
-            room = ""
+    # every display in its own slot, so they don't all come back in the same second
+    if cfg.effect:
+        response.headers["Refresh"] = str(jittered(cfg, 300))
+    else:
+        # the page polls data.json and changes its slides itself, this is just in case
+        response.headers["Refresh"] = str(jittered(cfg, PAGE_SAFETY_REFRESH))
 
-        is_jugend = is_jugend or room == "Jugendräume"  # temporary special case?!
+    # the cached page changes with the display, browsers have to ask again
+    patch_response_headers(response, cache_timeout=PAGE_CLIENT_MAX_AGE)
+    return response
 
-        start = datetime.fromisoformat(start)
-        end = datetime.fromisoformat(end)
 
-        if not is_aware(start):
-            start = make_aware(start, timezone.utc)
+def show_presentation_data(request, display):
+    """
+    what the slideshow shows, for the page to update itself. answers If-None-Match with 304.
+    """
+    show_controls = not not request.GET.get("kontrolle")
+    portrait = not not request.GET.get("portrait")
+    cfg = find_display(display)
 
-        if not is_aware(end):
-            end = make_aware(end, timezone.utc)
+    items = list(iter_items(cfg))
 
-        data = Event(start, end, summary, allday, is_jugend, room)
+    def build():
+        context, data = presentation_data(cfg, items, portrait, show_controls)
+        return data, presentation_timeout(cfg, context)
 
-        if start_of_day <= start <= end_of_day:
-            today_events.append(data)
+    data, _ = single_flight(
+        page_key(cfg, items, portrait, show_controls, "data.json"),
+        last_good_key(cfg, portrait, show_controls, "data.json"),
+        build,
+    )
+    if data is None:
+        return still_building()
 
-        if start - timedelta(hours=1) <= n <= start:  # event start within the hour
-            next_event = data
+    etag = quote_etag(data["hash"])
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = JsonResponse(data)
+        response.headers["ETag"] = etag
 
-        elif (
-                start <= n <= start + timedelta(hours=1)
-        ):  # event did start in the last hour
-            current_event = data
+    patch_cache_control(response, no_cache=True)
+    return response
 
-        if end_of_day <= start <= n + timedelta(days=30):
-            if len(next_events) < 6 or next_events[-1].start.day == data.start.day:
-                # inlcude max 6 events but always finish the day
-                next_events.append(data)
 
-        if (
-                is_preview_event
-                and data not in today_events
-                and data not in next_events
-        ):
-            preview_events.append(data)
+def still_building():
+    """
+    somebody else builds the page and there is no old one, ask again in a moment
+    """
+    response = HttpResponse("Die Seite wird gerade gebaut.", status=503, content_type="text/plain; charset=utf-8")
+    response.headers["Retry-After"] = str(BUILD_RETRY_AFTER)
+    # kiosk browsers don't know Retry-After
+    response.headers["Refresh"] = str(BUILD_RETRY_AFTER)
+    patch_cache_control(response, no_store=True)
+    return response
 
-        if is_special_event and not special_event:
-            special_event = data
 
-    return (today_events, next_event, current_event, next_events, preview_events, special_event)
+async def show_presentation_events(request, display):
+    """
+    server-sent events, a message whenever the slideshow should fetch its data.json
+    """
+    cfg = await sync_to_async(find_display)(display)
 
+    if isinstance(request, ASGIRequest):
+        response = StreamingHttpResponse(push.stream(cfg), content_type="text/event-stream")
+    else:
+        # a stream would keep a worker thread busy, so this is the fingerprint and "ask again later"
+        value = await sync_to_async(push.fingerprint)(cfg)
+        response = StreamingHttpResponse([push.message(value, retry=settings.PUSH_WSGI_RETRY)], content_type="text/event-stream")
 
-def iter_items(cfg):
-    n = now()
-    return cfg.items.filter(show_start__lt=n, show_end__gt=n).order_by("position")
+    patch_cache_control(response, no_cache=True)
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
 
-@xframe_options_sameorigin
-@cache_page(60 * 15)
-def show_presentation(request, display="", portrait=""):
-    show_controls = not not request.GET.get("kontrolle") # should be UserAgent or something like that.
-    portrait = not not portrait
-    try:
-        cfg = DisplayConfiguration.objects.get(name=display)
-    except DisplayConfiguration.DoesNotExist:
-        cfg = DisplayConfiguration.objects.order_by("name").first()
 
+def render_presentation(request, cfg, items, portrait, show_controls):
+    """
+    the page and how long it may be cached
+    """
     if cfg.effect:
         response = render(
             request,
             f"display/{cfg.effect}.html",
             context=dict(portrait=portrait))
+        return response, page_timeout(cfg)
 
-        response.headers["Refresh"] = "300"
-        return response
+    context, data = presentation_data(cfg, items, portrait, show_controls)
+    response = render(
+        request,
+        "display/slideshow.html",
+        context=dict(
+            context,
+            display=cfg,
+            rendered_slides=data["slides"],
+            slide_hashes=[slide["hash"] for slide in data["slides"]],
+            layout=data["layout"],
+            data_hash=data["hash"],
+            poll_offset=poll_offset(cfg),
+            # a connection that ended less than this many milliseconds ago still counts as push
+            push_grace=2 * settings.PUSH_WSGI_RETRY * 1000,
+        ),
+    )
+    return response, presentation_timeout(cfg, context)
+
+
+def poll_offset(cfg):
+    """
+    milliseconds the slideshow waits before polling every minute, each display in its own slot
+    """
+    rank, count = refresh_slot(cfg)
+    return 60000 * rank // count
+
+
+def presentation_timeout(cfg, context):
+    timeout = page_timeout(cfg)
+    if any(slidetype == "countdown" for slidetype, slide in context["slides"]):
+        # "noch 3 Stunden, 12 Minuten"
+        timeout = min(timeout, 60)
 
+    if context["missing_sources"]:
+        # built without a source that was never fetched, the fetch may end with a version we don't see
+        timeout = min(timeout, settings.PREFETCH_TIMEOUT)
 
+    return timeout
+
+
+def presentation_context(cfg, items, portrait, show_controls):
     slides = []
     now_slide = None
-    calendar_events = {} # cache calendar events
     today_events = []
     next_event = None
     current_event = None
@@ -413,7 +244,9 @@ def show_presentation(request, display="", portrait=""):
 
     n = now()
 
-    for item in iter_items(cfg):
+    data = fetch_all(items)
+
+    for item in items:
         if item.typ == "banner":
             if item.now_start is not None and item.now_start < n and item.now_start + item.how_long > n:
                 now_slide = item.banner
@@ -422,20 +255,12 @@ def show_presentation(request, display="", portrait=""):
                 slides.append(("banner", item.banner))
 
         elif item.typ == "gottesdienste":
-            try:
-                slides.append(("kalender_raum", ("Gottesdienste", scrape_gottesdienste())))
-            except Exception as e:
-                if settings.DEBUG:
-                    raise
-                mail_admins("scrape_gottesdienste() nicht so gut", str(e))
-                logger.exception("scrape_gottesdienste() nicht so gut")
+            # failures are reported by display.sources, we get the last good result or nothing.
+            if events := data.get(GOTTESDIENSTE_KEY):
+                slides.append(("kalender_raum", ("Gottesdienste", events)))
 
         elif item.calendar: # kalender item
-            if item.calendar.pk in calendar_events:
-                today_events, next_event, current_event, next_events, preview_events, special_event = calendar_events[item.calendar.pk]
-            else:
-                today_events, next_event, current_event, next_events, preview_events, special_event = load_events(item.calendar)
-                calendar_events[item.calendar.pk] = (today_events, next_event, current_event, next_events, preview_events, special_event)
+            today_events, next_event, current_event, next_events, preview_events, special_event = data.get(calendar_key(item.calendar), NO_EVENTS)[:6]
 
 
             if (today_events or now_slide) and next_events and item.typ=="next_events":
@@ -449,26 +274,44 @@ def show_presentation(request, display="", portrait=""):
 
 
 
-    response = render(
-        request,
-        "display/slideshow.html",
-        context=dict(
-            slides=slides,
-            today_events=today_events,
-            next_events=next_events,
-            special_event=special_event,
-            marker_event=current_event or next_event,
-            show_controls=show_controls,
-            now_slide=now_slide,
-            portrait=portrait,
-            two_column=cfg.two_column,
-            show_clock=cfg.show_clock,
-        ),
+    return dict(
+        slides=slides,
+        missing_sources=sorted(set(source_keys(items)) - set(data)),
+        today_events=today_events,
+        next_events=next_events,
+        special_event=special_event,
+        marker_event=current_event or next_event,
+        show_controls=show_controls,
+        now_slide=now_slide,
+        portrait=portrait,
+        two_column=cfg.two_column,
+        show_clock=cfg.show_clock,
     )
 
-    response.headers["Refresh"] = "300"
 
-    return response
+def presentation_data(cfg, items, portrait, show_controls):
+    """
+    the context of the slideshow, and what of it goes to data.json: every slide rendered on its
+    own with a hash, so the page can swap just the ones that changed.
+    """
+    context = presentation_context(cfg, items, portrait, show_controls)
+
+    slides = []
+    for slidetype, slide in context["slides"]:
+        html = render_to_string("display/snippet_slide.html", dict(context, slidetype=slidetype, slide=slide))
+        slides.append(dict(type=slidetype, html=html, hash=hashlib.sha1(html.encode()).hexdigest()))
+
+    now_slide = context["now_slide"]
+    data = dict(
+        # when this changes, the page has to be loaded again
+        layout=hashlib.sha1(repr((cfg.effect, cfg.two_column, cfg.show_clock, portrait, show_controls)).encode()).hexdigest(),
+        slides=slides,
+        today_events=[event._asdict() for event in context["today_events"]],
+        next_events=[event._asdict() for event in context["next_events"]],
+        now_slide=dict(title=now_slide.title, image=now_slide.image.url) if now_slide else None,
+    )
+    data["hash"] = hashlib.sha1(json.dumps(data, sort_keys=True, cls=DjangoJSONEncoder).encode()).hexdigest()
+    return context, data
 
 
 class DateTimeLocalInput(DateTimeInput):
@@ -518,31 +361,14 @@ def banner_edit(request, pk):
 
 @login_required
 def wartungsklappe(request):
+    things = {}
     try:
-        token = SocialToken.objects.get(
-            account__user=request.user, account__provider="google"
-        )
-    except SocialToken.DoesNotExist:
-        token = None
-        things = {}
-
-    if token:
-        credentials = Credentials(
-            token=token.token,
-            refresh_token=token.token_secret,
-            token_uri="https://oauth2.googleapis.com/token",
-            client_id=settings.SOCIALACCOUNT_PROVIDERS["google"]["APP"][
-                "client_id"
-            ],  # replace with yours
-            client_secret=settings.SOCIALACCOUNT_PROVIDERS["google"]["APP"]["secret"],
-        )  # replace with yours
-
-        service = build("calendar", "v3", credentials=credentials)
-        try:
-            things = service.calendarList().list().execute()
-        except RefreshError as e:
-            logger.exception("Refresh woes in wartungsklappe")
-            things = dict(items=[])
+        credentials = get_credentials(request.user)
+        if credentials:
+            things = calendar_service(credentials).calendarList().list().execute()
+    except RefreshError as e:
+        logger.exception("Refresh woes in wartungsklappe")
+        things = dict(items=[])
 
     # Call the Calendar API
     # now = datetime.datetime.utcnow().isoformat() + 'Z'  # 'Z' indicates UTC time
@@ -570,19 +396,18 @@ def wartungsklappe(request):
 
     if request.method == "POST":
         if "nuke" in request.POST:
-            cache.clear()
+            forget_pages(DisplayConfiguration.objects.values_list("pk", flat=True))
             messages.success(request, "Frisch durchgewischt! 🪣")
 
         elif f := request.FILES.get("file"):
             new_banner = ImageSlide.objects.create(title=f"Neuer Banner  ({now().strftime('%d.%m.%y %H:%M:%S')})")
             new_banner.image.save(f.name, f)
 
-            for cfg in DisplayConfiguration.objects.all():
-                for item in cfg.items.all():
-                    if item.typ == "banner" and item.banner.pk == new_banner.pk:
-                        break
-                else:
-                    cfg.items.create(typ="banner", banner=new_banner)
+            displays = list(DisplayConfiguration.objects.exclude(items__banner=new_banner))
+            DisplayConfigurationItem.objects.bulk_create(
+                [DisplayConfigurationItem(display=cfg, typ="banner", banner=new_banner) for cfg in displays])
+            # bulk_create sends no signals
+            forget_pages([cfg.pk for cfg in displays])
 
             messages.success(request, "Neuer Banner erstellt und auf allen Displays aktiviert.")
 
@@ -619,33 +444,77 @@ def wartungsklappe(request):
             new_calendars=new_calendars.items(),
             connected_calendars=connected_calendars.items(),
             banner=banner,
+            sources=source_states(),
+            breakers=breakers(),
+            connections=push_connections(),
         ),
     )
 
 
-def should_be_always_on(n):
+def push_connections():
+    """
+    (display, open connections) for the wartungsklappe
+    """
+    counts = push.connection_counts()
+    return [(cfg, counts.get(cfg.pk, 0)) for cfg in DisplayConfiguration.objects.order_by("name")]
+
+
+def display_timeline(cfg):
     """
-    this needs a way to configure always on time (like crontab entries, for stull like every Wednesday vom 9-5
-    FIXME: this is a temporary solution with the gemeindebüro zeiten
+    the Timeline of cfg for today. cached until one of its inputs changes: the items or the calendar syncs.
+    at most for CALENDAR_SYNC_INTERVAL, so without the prefetch command the calendars are still synced.
     """
-    if n.isoweekday() in (2,4): # tuesdays and thursdaus
-        if 8 <= n.hour <= 12: # 10-12 CET in UTC plus one hour in each direction
-            return True
+    items = list(iter_items(cfg))
+    day = start_of_day()
+
+    fingerprint = [day, availability_version()]
+    for item in items:
+        fingerprint.append((item.pk, item.typ, item.now_start, item.how_long))
+        if item.calendar:
+            fingerprint.append((item.calendar.pk, item.calendar.last_sync))
+
+    key = f"timeline:{cfg.pk}:{hashlib.sha1(repr(fingerprint).encode()).hexdigest()}"
+    timeline = cache.get(key)
+    if timeline is not None:
+        return timeline
+
+    # the timeline only looks at calendars, the gottesdienste are not scraped for it
+    calendar_items = [item for item in items if item.calendar and item.typ != "gottesdienste"]
+    fetched = fetch_all(calendar_items)
+    intervals = []
+    for item in items:
+        if item.typ == "banner" and item.now_start:
+            intervals.append((item.now_start - timedelta(hours=1), item.now_start + item.how_long + timedelta(hours=1)))
 
-    if n.isoweekday() == 3: # wednesdays
-        if 13 <= n.hour <= 17: # 15-17 CET in UTC plus one hour in each direction
-            return True
+        elif item.calendar:
+            today = fetched.get(calendar_key(item.calendar), NO_EVENTS).today_index
+            if not today:
+                # no events at all: nobody's there, not even in office hours
+                continue
 
-    return False
+            intervals.extend(always_on_intervals(cfg.pk, day))
+            # from an hour before an event starts until an hour after it ended
+            intervals.extend((event.start - timedelta(hours=1), event.end + timedelta(hours=1)) for event in today.events)
+
+    timeline = Timeline(intervals, day, day + timedelta(days=1))
+    # a calendar that was never fetched would be OFF all day, ask again next time
+    if all(calendar_key(item.calendar) in fetched for item in calendar_items):
+        cache.set(key, timeline, min((timeline.end - now()).total_seconds(), settings.CALENDAR_SYNC_INTERVAL))
+    return timeline
 
 
 def display_status(request, display):
     cfg = get_object_or_404(DisplayConfiguration, name=display)
     preview = request.GET.get("vorschau")
-    data = {}
-    ns = [now().replace(minute=0, second=30)]
+    timeline = display_timeline(cfg)
 
     if preview:
+        # the table only changes with the timeline
+        etag = quote_etag(hashlib.sha1(repr((timeline.begin, timeline.starts, timeline.ends)).encode()).hexdigest())
+        response = get_conditional_response(request, etag=etag)
+        if response is not None:
+            return response
+
         ns = [now().replace(hour=2, minute=0, second=30)]
         for step in range(48):
             ns.append(ns[-1] + timedelta(minutes=30))
@@ -653,53 +522,25 @@ def display_status(request, display):
                 ns.pop()
                 break
 
-
-    for item in iter_items(cfg):
-        if item.typ == "banner" and item.now_start:
-            for n in ns:
-                active = data.get(n, False)
-                if active:
-                    continue
-
-                active |= item.now_start - timedelta(hours=1) <= n <= item.now_start + item.how_long + timedelta(hours=1)
-
-                data[n] = active
-
-                if active and not preview:
-                    break
-
-
-        elif item.calendar:
-            today_events = load_events(item.calendar)[0]
-            if not today_events:
-                break
-
-            for n in ns:
-                active = data.get(n, False)
-                if active:
-                    continue
-
-                active |= should_be_always_on(n)
-
-                for event in today_events:
-                    active |= n - timedelta(hours=1) <= event.start <= n + timedelta(hours=1)
-                    active |= event.start <= n <= event.end + timedelta(hours=1)
-                    if active:
-                        break
-
-                data[n] = active
-
-                if active and not preview:
-                    break
-
-    if len(data) > 1 or preview:
-        return render(
+        response = render(
             request,
             "display/onoff.html",
-            context=dict(rows=data.items()))
-
-    if data and list(data.values())[0]:
-        return HttpResponse("ON", status=200)
+            context=dict(rows=[(n, timeline.is_on(n)) for n in ns]))
+        response.headers["ETag"] = etag
+        patch_cache_control(response, no_cache=True)
+        return response
 
+    n = now()
+    if timeline.is_on(n):
+        response = HttpResponse("ON", status=200)
     else:
-        return HttpResponse("OFF", status=204)
+        response = HttpResponse("OFF", status=204)
+
+    # the kiosk can sleep until then
+    transition = timeline.next_transition(n)
+    response.headers["X-Next-Transition"] = transition.isoformat()
+
+    # the answer holds until the next transition, unless a calendar sync brings new events
+    max_age = min((transition - n).total_seconds(), settings.CALENDAR_SYNC_INTERVAL)
+    patch_response_headers(response, cache_timeout=max(int(max_age), 0))
+    return response
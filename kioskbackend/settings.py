@@ -188,6 +188,38 @@ SOCIALACCOUNT_PROVIDERS = {
 
 SOCIALACCOUNT_STORE_TOKENS = True
 
+# Calendar events are kept in the database and synced incrementally with google.
+# seconds between two syncs of the same calendar
+CALENDAR_SYNC_INTERVAL = int(os.environ.get("CALENDAR_SYNC_INTERVAL", "300"))
+# how many days ahead to keep in the local event store
+CALENDAR_SYNC_DAYS = int(os.environ.get("CALENDAR_SYNC_DAYS", "90"))
+
+# manage.py prefetch puts parsed calendar events and gottesdienste into the cache
+# every PREFETCH_INTERVAL seconds, they stay there for PREFETCH_TIMEOUT seconds.
+PREFETCH_INTERVAL = int(os.environ.get("PREFETCH_INTERVAL", "60"))
+PREFETCH_TIMEOUT = int(os.environ.get("PREFETCH_TIMEOUT", str(5 * PREFETCH_INTERVAL)))
+# sources missing in the cache are fetched in parallel by this many threads,
+# a display waits at most SOURCE_TIMEOUT seconds for them
+SOURCE_WORKERS = int(os.environ.get("SOURCE_WORKERS", "4"))
+SOURCE_TIMEOUT = float(os.environ.get("SOURCE_TIMEOUT", "10"))
+# rendered displays are cached this long, or until the display or its data changes
+PAGE_CACHE_TIMEOUT = int(os.environ.get("PAGE_CACHE_TIMEOUT", str(24 * 60 * 60)))
+# server-sent events for the displays (display.push): changes are looked for every
+# PUSH_INTERVAL seconds, a connection is closed after PUSH_MAX_AGE seconds and opened
+# again by the browser. without ASGI the browser polls every PUSH_WSGI_RETRY seconds.
+PUSH_INTERVAL = float(os.environ.get("PUSH_INTERVAL", "2"))
+PUSH_MAX_AGE = int(os.environ.get("PUSH_MAX_AGE", "600"))
+PUSH_WSGI_RETRY = int(os.environ.get("PUSH_WSGI_RETRY", "60"))
+# outbound http: timeouts in seconds, retries of failed GETs, and after
+# HTTP_BREAKER_FAILURES failures in a row a host is not asked for HTTP_BREAKER_RESET seconds
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", "20"))
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", "2"))
+HTTP_BREAKER_FAILURES = int(os.environ.get("HTTP_BREAKER_FAILURES", "5"))
+HTTP_BREAKER_RESET = int(os.environ.get("HTTP_BREAKER_RESET", "60"))
+# the gottesdienste change about once a week, their page is checked every GOTTESDIENSTE_MAX_AGE seconds
+GOTTESDIENSTE_MAX_AGE = int(os.environ.get("GOTTESDIENSTE_MAX_AGE", "3600"))
+
 EMAIL_HOST = os.environ.get("SMTP_HOST")
 EMAIL_PORT = int(os.environ.get("SMTP_PORT", "465"))
 EMAIL_HOST_USER = os.environ.get("SMTP_USER")
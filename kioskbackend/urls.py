@@ -21,7 +21,8 @@ from django.conf import settings
 from django.views.decorators.cache import cache_control
 from django.views.static import serve
 
-from display.views import show_presentation, wartungsklappe, banner_edit, index, kalender_dump, display_status
+from display.views import show_presentation, wartungsklappe, banner_edit, index, kalender_dump, display_status, \
+    show_presentation_data, show_presentation_events
 
 urlpatterns = [
     path("accounts/", include("allauth.urls")),
@@ -30,6 +31,8 @@ urlpatterns = [
     path("display/", show_presentation, name="slideshow"),
     path("display/<display>", show_presentation, name="slideshow_for_display"),
     path("status/<display>", display_status, name="display_active"),
+    path("display/<display>/data.json", show_presentation_data, name="slideshow_data"),
+    path("display/<display>/events", show_presentation_events, name="slideshow_events"),
     path("display/<display>/<portrait>", show_presentation, name="slideshow_for_display_portrait"),
     path("wartungsklappe/", wartungsklappe, name="wartungsklappe"),
     path("wartungsklappe/banner/<int:pk>", banner_edit, name="banneredit"),
@@ -11,5 +11,6 @@ pipenv run python manage.py createcachetable
 # Danger wil robinson.
 pipenv run python manage.py migrate --noinput
 
+# also starts the prefetcher and uvicorn for the push events, see uwsgi.ini
 uwsgi --ini /usr/src/app/uwsgi.ini
 